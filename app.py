@@ -1,25 +1,50 @@
 import sqlite3
 from datetime import datetime, timedelta
-from typing import Any, Tuple, Optional, Dict, List
+from typing import IO, Any, Callable, Iterable, Iterator, Mapping, Tuple, Optional, Dict, List, Set, TypeVar
+from contextlib import closing, contextmanager
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 import logging
+import json
+import re
 import sys
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file
+import queue
+import threading
+import atexit
+import multiprocessing
+import time
+from flask import Flask, Response, g, render_template, request, jsonify, redirect, url_for, send_file, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user  # type: ignore
 import qrcode  # type: ignore
+import qrcode.image.svg  # type: ignore
+import numpy as np
 import pandas as pd  # type: ignore
 import io
 import os
+from pathlib import Path
 from PIL import Image
 import base64
+import codecs
+import csv
+import hashlib
 import secrets
+import tempfile
+import gzip
+import shutil
+import zipfile
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import pytz
 from enum import Enum
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.utils import secure_filename
 
 from config import Config
+import qr_badges
 
 # ロギング設定
 logger = logging.getLogger(__name__)
@@ -36,6 +61,119 @@ MAX_DAILY_PERSONAL_IN = 5
 MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
 MAX_PHOTO_SIZE = 10 * 1024 * 1024  # 10MB
 
+# データベース接続設定
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(64 * 1024 * 1024)))  # 64MB
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))  # 16MB
+
+# レポート用スナップショットの更新間隔（秒）。0でスナップショットを使わずライブDBを読む
+REPORT_SNAPSHOT_MAX_AGE = int(os.environ.get('REPORT_SNAPSHOT_MAX_AGE', '60'))
+REPORT_SNAPSHOT_BACKUP_PAGES = 1024
+
+# 打刻INSERTのグループコミット（単一ライタースレッドでまとめてコミット）
+PUNCH_GROUP_COMMIT = os.environ.get('PUNCH_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+PUNCH_BATCH_MAX_ROWS = int(os.environ.get('PUNCH_BATCH_MAX_ROWS', '64'))
+PUNCH_BATCH_MAX_WAIT_MS = int(os.environ.get('PUNCH_BATCH_MAX_WAIT_MS', '5'))
+PUNCH_COMMIT_TIMEOUT = 30  # 秒
+
+# 打刻APIの Idempotency-Key（再送時は最初の応答を返す）
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+IDEMPOTENCY_CACHE_SIZE = 1024
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_PRUNE_INTERVAL = 600  # 秒
+IDEMPOTENCY_WAIT_TIMEOUT = 60  # 同じキーの処理中リクエストを待つ上限（秒）
+
+# オフライン端末からの一括打刻
+BATCH_PUNCH_MAX_ITEMS = 500
+BATCH_PUNCH_MAX_AGE_DAYS = 7
+BATCH_PUNCH_MAX_FUTURE_SECONDS = 300  # 端末の時計ずれの許容範囲
+
+# 打刻写真の非同期処理（ワーカースレッド数とキュー上限）
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', '2'))
+PHOTO_QUEUE_MAX = int(os.environ.get('PHOTO_QUEUE_MAX', '64'))
+PHOTO_SUBMIT_TIMEOUT = 0.5  # 秒。超えた場合はリクエスト内で処理
+PHOTO_DRAIN_TIMEOUT = 30  # 秒
+PHOTO_PENDING_PREFIX = 'pending:'
+
+# 写真の縮小版（serve_photo の ?size=）: サイズ名 -> 長辺の最大ピクセル数
+PHOTO_VARIANT_SIZES: Dict[str, int] = {
+    'small': 160,
+    'medium': 640
+}
+PHOTO_VARIANT_QUALITY = 80
+
+# 保存する打刻写真の長辺の上限（ピクセル）。これより大きい写真は縮小して保存する
+PHOTO_MAX_DIMENSION = int(os.environ.get('PHOTO_MAX_DIMENSION', '1280'))
+
+# 写真の保存形式（日付別ディレクトリ + 内容ハッシュのファイル名）
+PHOTO_PATH_PREFIX = 'static/photos/'
+PHOTO_HASH_LENGTH = 32
+PHOTO_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif'}
+
+# 写真のメンテナンス（maintain_photos.py）
+# 保存期間（日）: これより古い勤務日の写真は参照を外して削除する。0 は無期限
+PHOTO_RETENTION_DAYS = int(os.environ.get('PHOTO_RETENTION_DAYS', '0'))
+# 撮影からこの日数を過ぎた写真を PHOTO_RECOMPRESS_QUALITY で再圧縮する。0 は再圧縮しない
+PHOTO_RECOMPRESS_AFTER_DAYS = int(os.environ.get('PHOTO_RECOMPRESS_AFTER_DAYS', '0'))
+PHOTO_RECOMPRESS_QUALITY = int(os.environ.get('PHOTO_RECOMPRESS_QUALITY', '60'))
+PHOTO_MAINTENANCE_BATCH_SIZE = 500
+# 保存直後（打刻登録前）のファイルを孤立ファイルとして削除しないための猶予
+PHOTO_ORPHAN_GRACE_SECONDS = 3600
+
+# 顔認証: face-api.js の顔特徴量（128次元）。ユークリッド距離がこれ以下なら本人と判定
+FACE_DESCRIPTOR_LENGTH = 128
+FACE_DISTANCE_THRESHOLD = float(os.environ.get('FACE_DISTANCE_THRESHOLD', '0.4'))
+FACE_IDENTIFY_DEFAULT_K = 3
+FACE_IDENTIFY_MAX_K = 10
+
+# face-api.js のモデル（build_face_models.py で static/models/build にフィンガープリント付きで出力）
+FACE_MODEL_SOURCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'models')
+FACE_MODEL_BUILD_FOLDER = os.path.join(FACE_MODEL_SOURCE_FOLDER, 'build')
+FACE_MODEL_FINGERPRINT_LENGTH = 16
+# 事前圧縮の形式（Accept-Encoding での優先順）と拡張子
+FACE_MODEL_ENCODINGS: Dict[str, str] = {
+    'br': '.br',
+    'gzip': '.gz'
+}
+
+# QRコード（/qr/<employee_id> で表示時に生成）
+QR_CACHE_SIZE = 512
+QR_DEFAULT_SCALE = 10  # 1モジュールあたりのピクセル数（SVGは 1/10 mm）
+QR_MAX_SCALE = 40
+QR_ERROR_CORRECTION_LEVELS: Dict[str, int] = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H
+}
+QR_FORMATS: Dict[str, str] = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml'
+}
+
+# QRコード名札の一括出力（/api/employees/qr-badges）: 描画するプロセス数
+QR_BADGE_WORKERS = int(os.environ.get('QR_BADGE_WORKERS', str(os.cpu_count() or 1)))
+QR_BADGE_POOL_MIN_TASKS = 4  # これ未満のページ・枚数はプロセスを起動せずに描画
+
+# 写真・QRコードの配信キャッシュ
+# 内容ハッシュ名の写真（と縮小版）は内容が変わらないため immutable で長期キャッシュ
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # 1年
+# STATIC_SENDFILE: 'x-accel-redirect'（nginx）/ 'x-sendfile'（Apache等）で本体の送信をプロキシに任せる
+STATIC_SENDFILE = os.environ.get('STATIC_SENDFILE', '').strip().lower()
+# X-Accel-Redirect 用: PERSISTENT_STORAGE_PATH を公開する nginx の internal location
+STATIC_ACCEL_PREFIX = '/' + os.environ.get('STATIC_ACCEL_PREFIX', '/protected/').strip('/') + '/'
+
+# 写真アップロード（multipart / 画像本文）の受信: これを超える写真は一時ファイルへ退避
+PHOTO_SPOOL_MAX_MEMORY = 1024 * 1024  # 1MB
+PHOTO_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# CSVエクスポート: DBから一度に読み込んで書き出す行数（ファイル全体はメモリに載せない）
+CSV_EXPORT_FETCH_SIZE = 1000
+
+# 月別アーカイブ: ホットDBに残す過去の月数（当月は常にホットDB）
+ARCHIVE_KEEP_MONTHS = int(os.environ.get('ARCHIVE_KEEP_MONTHS', '1'))
+
 # Azure App Service用の環境変数読み込み
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -59,6 +197,10 @@ if os.name == 'posix':  # Linux/Unix (Azure)
 else:  # Windows
     PERSISTENT_STORAGE_PATH = os.path.dirname(os.path.abspath(__file__))
 
+DB_PATH = os.path.join(PERSISTENT_STORAGE_PATH, 'timecard.db')
+REPORT_SNAPSHOT_PATH = os.path.join(PERSISTENT_STORAGE_PATH, 'timecard_report.db')
+ARCHIVE_FOLDER = os.path.join(PERSISTENT_STORAGE_PATH, 'archive')
+
 app.config['QR_FOLDER'] = os.path.join(PERSISTENT_STORAGE_PATH, 'static', 'qrcodes')
 app.config['PHOTO_FOLDER'] = os.path.join(PERSISTENT_STORAGE_PATH, 'static', 'photos')
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
@@ -77,6 +219,98 @@ login_manager = LoginManager()
 login_manager.init_app(app)  # type: ignore
 login_manager.login_view = 'admin_login'  # type: ignore
 
+# === 打刻データの保存形式 ===
+
+# action / location 列は小さな整数コードで保存する
+ACTION_CODES: Dict[str, int] = {
+    'in': 1,
+    'out': 2,
+    'out_personal': 3,
+    'in_personal': 4,
+    'break_out': 5,
+    'break_in': 6
+}
+ACTION_NAMES: Dict[int, str] = {code: name for name, code in ACTION_CODES.items()}
+UNKNOWN_ACTION_CODE = 0
+
+LOCATION_CODES: Dict[str, int] = {
+    'モバイル': 1,
+    '手動': 2,
+    'テスト': 3,
+    'オフライン': 4
+}
+LOCATION_NAMES: Dict[int, str] = {code: name for name, code in LOCATION_CODES.items()}
+
+# 旧データに残る 'YYYY-MM-DD HH:MM:SS:ms' 形式
+_LEGACY_MILLIS_TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}):(\d+)$')
+
+# 表示・デバッグ用に名称へ戻した timecard の列一覧
+TIMECARD_COLUMNS = (
+    "id, employee_id, timestamp, ts_epoch, work_date, action_name(action) AS action, "
+    "photo_path, location_name(location) AS location, break_type, device_id"
+)
+
+def decode_action(code: Optional[int]) -> Optional[str]:
+    """アクションコードを名称に変換"""
+    if code is None:
+        return None
+    return ACTION_NAMES.get(code, 'unknown')
+
+def decode_location(code: Optional[int]) -> Optional[str]:
+    """場所コードを名称に変換"""
+    if code is None:
+        return None
+    return LOCATION_NAMES.get(code)
+
+def parse_timestamp(value: str) -> datetime:
+    """保存形式が混在するタイムスタンプ文字列をJSTのdatetimeに変換"""
+    text = value.strip().replace('T', ' ')
+    legacy = _LEGACY_MILLIS_TIMESTAMP.match(text)
+    if legacy:
+        text = f"{legacy.group(1)}.{legacy.group(2)}"
+
+    parsed = datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        return JST.localize(parsed)
+    return parsed.astimezone(JST)
+
+def parse_legacy_timestamp(value) -> Optional[datetime]:
+    """
+    旧バージョンの形式（'2024/01/05 08:00' など）も含めてタイムスタンプを変換
+
+    parse_timestamp で変換できない値は、従来の集計（pd.to_datetime(format='mixed')）が
+    受け付けていた形式として解釈する。それでも変換できない場合は None を返す。
+    """
+    if value is None:
+        return None
+    try:
+        return parse_timestamp(str(value))
+    except ValueError:
+        pass
+    try:
+        parsed = pd.to_datetime(str(value).strip(), format='mixed')
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if pd.isna(parsed):
+        return None
+    parsed = parsed.to_pydatetime()
+    if parsed.tzinfo is None:
+        return JST.localize(parsed)
+    return parsed.astimezone(JST)
+
+def to_work_date(date_str: str) -> int:
+    """'YYYY-MM-DD' を work_date 列の整数 (YYYYMMDD) に変換"""
+    return int(datetime.strptime(date_str, '%Y-%m-%d').strftime('%Y%m%d'))
+
+def timecard_time_columns(timestamp: datetime) -> Tuple[str, int, int]:
+    """timecard の timestamp / ts_epoch / work_date 列の値を生成"""
+    local_time = timestamp.astimezone(JST) if timestamp.tzinfo else JST.localize(timestamp)
+    return (
+        local_time.strftime('%Y-%m-%d %H:%M:%S'),
+        int(local_time.timestamp()),
+        int(local_time.strftime('%Y%m%d'))
+    )
+
 # === 強化された整合性チェック機能 ===
 
 class EmployeeState(Enum):
@@ -85,6 +319,174 @@ class EmployeeState(Enum):
     WORKING = "working"            # 出勤中  
     PERSONAL_OUT = "personal_out"  # 退出中
 
+# アクションごとの状態遷移（休憩記録は状態を変えない）
+STATE_TRANSITIONS: Dict[str, EmployeeState] = {
+    'in': EmployeeState.WORKING,
+    'out': EmployeeState.NOT_ARRIVED,
+    'out_personal': EmployeeState.PERSONAL_OUT,
+    'in_personal': EmployeeState.WORKING
+}
+STATE_NEUTRAL_ACTIONS = ('break_out', 'break_in')
+
+PUNCH_ACTION_LABELS: Dict[str, str] = {
+    'in': '出勤',
+    'out': '退勤',
+    'out_personal': '退出',
+    'in_personal': '戻り',
+    'break_out': '休憩開始',
+    'break_in': '休憩終了'
+}
+
+def apply_punch_action(state: EmployeeState, action: Optional[str]) -> EmployeeState:
+    """打刻1件を適用した後の状態"""
+    if action in STATE_NEUTRAL_ACTIONS:
+        return state
+    return STATE_TRANSITIONS.get(action or '', EmployeeState.NOT_ARRIVED)
+
+def fold_daily_punches(actions: Iterable[Optional[str]]) -> Tuple[EmployeeState, Dict[str, int]]:
+    """時系列順のアクション列から当日の状態とアクション別回数を求める"""
+    state = EmployeeState.NOT_ARRIVED
+    counts: Dict[str, int] = {}
+    for action in actions:
+        state = apply_punch_action(state, action)
+        if action:
+            counts[action] = counts.get(action, 0) + 1
+    return state, counts
+
+class EmployeeStateCache:
+    """従業員ごとの当日の状態とアクション別回数のキャッシュ（スレッドセーフ）
+
+    打刻の登録時に更新し、打刻の修正・削除時に破棄する。JSTの日付が
+    変わると全体を破棄する。当日以外の日付はキャッシュしない。
+    DB読み込み中に更新・破棄が起きた場合は、世代番号で古い結果の保存を防ぐ。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[int, EmployeeState, Dict[str, int]]] = {}
+        self._generations: Dict[str, int] = {}
+        self._work_date = 0
+
+    def _roll_over(self) -> int:
+        today = int(datetime.now(JST).strftime('%Y%m%d'))
+        if today != self._work_date:
+            self._entries.clear()
+            self._generations.clear()
+            self._work_date = today
+        return today
+
+    def get(self, employee_id: str, work_date: int) -> Optional[Tuple[EmployeeState, Dict[str, int]]]:
+        with self._lock:
+            if work_date != self._roll_over():
+                return None
+            entry = self._entries.get(employee_id)
+            if entry is None:
+                return None
+            return entry[1], dict(entry[2])
+
+    def generation(self, employee_id: str) -> int:
+        with self._lock:
+            return self._generations.get(employee_id, 0)
+
+    def store(self, employee_id: str, work_date: int, state: EmployeeState,
+              counts: Dict[str, int], generation: int) -> None:
+        with self._lock:
+            if work_date != self._roll_over() or self._generations.get(employee_id, 0) != generation:
+                return
+            self._entries[employee_id] = (work_date, state, dict(counts))
+
+    def put(self, employee_id: str, work_date: int, state: EmployeeState, counts: Dict[str, int]) -> None:
+        """
+        打刻登録後の状態を反映
+
+        打刻トランザクション内（書き込みロック保持中）で呼ぶことで、
+        コミット順とキャッシュの更新順を一致させる。
+        """
+        with self._lock:
+            today = self._roll_over()
+            self._generations[employee_id] = self._generations.get(employee_id, 0) + 1
+            if work_date == today:
+                self._entries[employee_id] = (work_date, state, dict(counts))
+
+    def invalidate(self, employee_id: Optional[str] = None) -> None:
+        """キャッシュを破棄（employee_id 省略時は全従業員）"""
+        with self._lock:
+            if employee_id is None:
+                self._entries.clear()
+                self._generations.clear()
+                return
+            self._entries.pop(employee_id, None)
+            self._generations[employee_id] = self._generations.get(employee_id, 0) + 1
+
+employee_state_cache = EmployeeStateCache()
+
+class EmployeeDirectory:
+    """従業員名簿と顔データ登録状況のインメモリキャッシュ（スレッドセーフ）
+
+    初回参照時にDBから一括で読み込み、以後はメモリから返す。従業員の追加・削除、
+    顔データの登録時に bump() でバージョンを進め、次回参照時に再読み込みする。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._version = 0
+        self._loaded_version = -1
+        self._employees: Dict[str, Dict[str, Any]] = {}
+        self._face_registered: Set[str] = set()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump(self) -> None:
+        """名簿の変更を通知（次回参照時に再読み込み）"""
+        with self._lock:
+            self._version += 1
+
+    def _ensure_loaded(self) -> None:
+        with self._lock:
+            if self._loaded_version == self._version:
+                return
+            version = self._version
+        
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('SELECT * FROM employees ORDER BY id').fetchall()
+            face_rows = conn.execute('SELECT employee_id FROM face_data').fetchall()
+        finally:
+            conn.close()
+        
+        employees = {row['employee_id']: dict(row) for row in rows}
+        face_registered = {row['employee_id'] for row in face_rows}
+        with self._lock:
+            # 読み込み中に bump() された場合は読み込んだ内容を採用しない
+            if self._version == version:
+                self._employees = employees
+                self._face_registered = face_registered
+                self._loaded_version = version
+        logger.info(f"従業員名簿を読み込みました: {len(employees)}名（version={version}）")
+
+    def get(self, employee_id: str) -> Optional[Dict[str, Any]]:
+        """従業員IDから従業員情報を取得（存在しない場合は None）"""
+        self._ensure_loaded()
+        with self._lock:
+            employee = self._employees.get(employee_id)
+            return dict(employee) if employee else None
+
+    def list_all(self) -> List[Dict[str, Any]]:
+        """全従業員（登録順）"""
+        self._ensure_loaded()
+        with self._lock:
+            return [dict(employee) for employee in self._employees.values()]
+
+    def face_data_status(self) -> Dict[str, bool]:
+        """従業員IDごとの顔データ登録有無"""
+        self._ensure_loaded()
+        with self._lock:
+            return {employee_id: employee_id in self._face_registered for employee_id in self._employees}
+
+employee_directory = EmployeeDirectory()
+
 class PunchValidator:
     """打刻の整合性チェッククラス（修正版）"""
 
@@ -96,71 +498,59 @@ class PunchValidator:
             'in_personal': MAX_DAILY_PERSONAL_IN
         }
     
-    def get_employee_state(self, employee_id: str, target_date: str) -> EmployeeState:
-        """従業員の現在状態を取得"""
+    def get_daily_status(self, employee_id: str, target_date: str) -> Tuple[EmployeeState, Dict[str, int]]:
+        """従業員の現在状態と当日のアクション別打刻回数を取得（当日分はキャッシュ優先）"""
+        work_date = to_work_date(target_date)
+        cached = employee_state_cache.get(employee_id, work_date)
+        if cached:
+            return cached
+
+        generation = employee_state_cache.generation(employee_id)
         conn = get_db_connection()
+        try:
+            state, counts = self.load_daily_status(conn, employee_id, work_date)
+        finally:
+            conn.close()
         
+        employee_state_cache.store(employee_id, work_date, state, counts, generation)
+        return state, counts
+
+    def load_daily_status(self, conn: sqlite3.Connection, employee_id: str,
+                          work_date: int) -> Tuple[EmployeeState, Dict[str, int]]:
+        """指定した接続から当日の打刻を1回のクエリで読み、状態と回数を求める"""
         # 当日の打刻記録を時系列順で取得
-        punches = conn.execute('''
-            SELECT action, timestamp FROM timecard 
-            WHERE employee_id = ? AND DATE(timestamp) = ?
-            ORDER BY timestamp DESC
-        ''', (employee_id, target_date)).fetchall()
-        
-        conn.close()
+        rows = conn.execute('''
+            SELECT action FROM timecard 
+            WHERE employee_id = ? AND work_date = ?
+            ORDER BY ts_epoch ASC, id ASC
+        ''', (employee_id, work_date)).fetchall()
         
-        if not punches:
-            return EmployeeState.NOT_ARRIVED
-        
-        last_action = punches[0]['action']
-        
-        # 最後の打刻に基づいて状態を判定
-        if last_action == 'in':
-            return EmployeeState.WORKING
-        elif last_action == 'out':
-            return EmployeeState.NOT_ARRIVED
-        elif last_action == 'out_personal':
-            return EmployeeState.PERSONAL_OUT
-        elif last_action == 'in_personal':
-            return EmployeeState.WORKING
-        elif last_action in ['break_out', 'break_in']:
-            # 休憩記録は状態判定に影響しない
-            for punch in punches:
-                if punch['action'] in ['in', 'out', 'out_personal', 'in_personal']:
-                    last_real_action = punch['action']
-                    if last_real_action == 'in':
-                        return EmployeeState.WORKING
-                    elif last_real_action == 'out':
-                        return EmployeeState.NOT_ARRIVED
-                    elif last_real_action == 'out_personal':
-                        return EmployeeState.PERSONAL_OUT
-                    elif last_real_action == 'in_personal':
-                        return EmployeeState.WORKING
-                    break
-            return EmployeeState.NOT_ARRIVED
-        else:
-            return EmployeeState.NOT_ARRIVED
+        return fold_daily_punches(decode_action(row['action']) for row in rows)
+
+    def get_employee_state(self, employee_id: str, target_date: str) -> EmployeeState:
+        """従業員の現在状態を取得"""
+        return self.get_daily_status(employee_id, target_date)[0]
     
     def validate_punch(self, employee_id: str, action: str, target_date: Optional[str] = None) -> Tuple[bool, str]:
         """総合的な打刻検証（修正版）"""
         if not target_date:
             target_date = datetime.now(JST).strftime('%Y-%m-%d')
         
-        # 1. 従業員の現在状態を取得
-        current_state = self.get_employee_state(employee_id, target_date)
-        
+        # 1. 従業員の現在状態を取得（状態と回数は1回の参照で取得）
+        current_state, daily_counts = self.get_daily_status(employee_id, target_date)
+        return self.evaluate_punch(current_state, daily_counts, action)
+
+    def evaluate_punch(self, current_state: EmployeeState, daily_counts: Dict[str, int],
+                       action: str) -> Tuple[bool, str]:
+        """取得済みの状態と回数に対して打刻可否を判定"""
         # 2. 状態に基づいて許可されるアクションチェック
         allowed_actions = self.get_allowed_actions(current_state)
         if action not in allowed_actions:
             return False, self.get_state_error_message(current_state, action)
         
         # 3. 同一アクション重複チェック（修正：出勤・退勤のみ）
-        if action in ['in', 'out'] and self.is_duplicate_action(employee_id, action, target_date):
-            action_names = {
-                'in': '出勤', 'out': '退勤',
-                'out_personal': '退出', 'in_personal': '戻り'
-            }
-            return False, f"{action_names[action]}は既に打刻済みです"
+        if action in ['in', 'out'] and daily_counts.get(action, 0) > 0:
+            return False, self.get_duplicate_message(action)
         
         # 4. 退勤前の戻り打刻必須チェック（新規追加）
         if action == 'out' and current_state == EmployeeState.PERSONAL_OUT:
@@ -207,47 +597,793 @@ class PunchValidator:
         
         return f"{action_name}は現在実行できません"
     
+    def get_duplicate_message(self, action: str) -> str:
+        """同一アクション重複エラーメッセージ"""
+        action_names = {
+            'in': '出勤', 'out': '退勤',
+            'out_personal': '退出', 'in_personal': '戻り'
+        }
+        return f"{action_names.get(action, action)}は既に打刻済みです"
+
     def is_duplicate_action(self, employee_id: str, action: str, target_date: str) -> bool:
         """同一アクション重複チェック（修正版）"""
-        conn = get_db_connection()
-        
-        existing_punch = conn.execute('''
-            SELECT COUNT(*) as count FROM timecard 
-            WHERE employee_id = ? AND DATE(timestamp) = ? AND action = ?
-        ''', (employee_id, target_date, action)).fetchone()
-        
-        conn.close()
-        
-        count = existing_punch['count'] if existing_punch else 0
-        return count > 0
+        return self.get_daily_status(employee_id, target_date)[1].get(action, 0) > 0
 
 # グローバルバリデーターインスタンス
 punch_validator = PunchValidator()
 
 # === データベース関数 ===
 
+def register_sql_functions(conn: sqlite3.Connection) -> None:
+    """コード列を表示用の名称に戻すSQL関数を登録"""
+    conn.create_function('action_name', 1, decode_action, deterministic=True)
+    conn.create_function('location_name', 1, decode_location, deterministic=True)
+
+class PooledConnection(sqlite3.Connection):
+    """接続プールで再利用されるSQLite接続
+
+    close() は物理的な切断を行わず、最も外側の呼び出しで未コミットの
+    変更をロールバックしてプールへ返却する。
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkout_depth = 0
+
+    def close(self) -> None:
+        db_pool.release(self)
+
+    def disconnect(self) -> None:
+        """物理的に接続を閉じる"""
+        super().close()
+
+
+class ConnectionPool:
+    """スレッド単位で接続を共有するSQLite接続プール
+
+    同一スレッド（= 同一リクエスト）内の get_db_connection() 呼び出しは
+    すべて同じ接続を返すため、ルートとPunchValidatorが1本の接続を共有する。
+    PRAGMAは接続生成時に一度だけ適用する。
+    """
+
+    def __init__(self, db_path: str, max_idle: int) -> None:
+        self.db_path = db_path
+        self._idle: 'queue.LifoQueue[PooledConnection]' = queue.LifoQueue(maxsize=max_idle)
+        self._local = threading.local()
+
+    def _connect(self) -> PooledConnection:
+        logger.info(f"データベース接続を作成します: {self.db_path}")
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            factory=PooledConnection
+        )
+        conn.row_factory = sqlite3.Row
+
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        # 外部キー制約を有効化
+        conn.execute("PRAGMA foreign_keys = ON")
+        register_sql_functions(conn)
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        conn: Optional[PooledConnection] = getattr(self._local, 'conn', None)
+        if conn is None:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            self._local.conn = conn
+        conn.checkout_depth += 1
+        return conn
+
+    def release(self, conn: PooledConnection, force: bool = False) -> None:
+        if conn is not getattr(self._local, 'conn', None):
+            # 別スレッドの接続や返却済みの接続は対象外
+            return
+
+        conn.checkout_depth = 0 if force else conn.checkout_depth - 1
+        if conn.checkout_depth > 0:
+            return
+
+        self._local.conn = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.disconnect()
+
+    def release_current(self) -> None:
+        """現在のスレッドが保持している接続を強制的に返却"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self.release(conn, force=True)
+
+    def close_all(self) -> None:
+        """プール内の待機中接続をすべて閉じる"""
+        while True:
+            try:
+                self._idle.get_nowait().disconnect()
+            except queue.Empty:
+                break
+
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
 def get_db_connection() -> sqlite3.Connection:
     """
-    データベース接続を取得（OS対応版・外部キー有効化）
+    データベース接続を取得（プール版）
+
+    同一スレッド内ではネストした呼び出しでも同じ接続を返す。
+    conn.close() で返却され、最も外側の close() でプールへ戻る。
+    """
+    return db_pool.acquire()
+
+@app.teardown_request
+def release_db_connection(exception: Optional[BaseException]) -> None:
+    """リクエスト終了時に返却漏れの接続をプールへ戻す"""
+    db_pool.release_current()
+
+# === 月別アーカイブ ===
+
+def archive_path(month: int) -> str:
+    """月 (YYYYMM) のアーカイブDBファイルパス"""
+    return os.path.join(ARCHIVE_FOLDER, f'timecard_{month}.db')
+
+def archive_cutoff_month(now: Optional[datetime] = None) -> int:
+    """この月 (YYYYMM) より前の月がアーカイブ対象"""
+    now = now or datetime.now(JST)
+    month_index = now.year * 12 + (now.month - 1) - ARCHIVE_KEEP_MONTHS
+    return (month_index // 12) * 100 + month_index % 12 + 1
+
+def archive_closed_months(conn: sqlite3.Connection) -> Dict[int, int]:
+    """
+    締め済みの月の打刻記録を月別アーカイブDBへ移動
+
+    戻り値は {月 (YYYYMM): 移動件数}。途中で中断しても再実行で整合する
+    （アーカイブ側の同一IDは入れ替える）。
+    """
+    if conn.in_transaction:
+        conn.commit()
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+
+    cutoff = archive_cutoff_month()
+    months = [row['month'] for row in conn.execute(
+        "SELECT DISTINCT work_date / 100 AS month FROM timecard WHERE work_date < ? ORDER BY month",
+        (cutoff * 100 + 1,)
+    ).fetchall()]
+
+    moved: Dict[int, int] = {}
+    for month in months:
+        first_day, last_day = month * 100 + 1, month * 100 + 31
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(month),))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # 列構成はホットDBの timecard をそのまま引き継ぐ（既存のアーカイブには後から増えた列を追加）
+            conn.execute("CREATE TABLE IF NOT EXISTS archive.timecard AS SELECT * FROM main.timecard WHERE 0")
+            archive_columns = {row[1] for row in conn.execute("PRAGMA archive.table_info(timecard)").fetchall()}
+            for row in conn.execute("PRAGMA main.table_info(timecard)").fetchall():
+                if row[1] not in archive_columns:
+                    conn.execute(f"ALTER TABLE archive.timecard ADD COLUMN {row[1]} {row[2]}")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS archive.idx_timecard_employee_date ON timecard (employee_id, work_date, ts_epoch)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS archive.idx_timecard_work_date ON timecard (work_date)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS archive.idx_timecard_photo_path ON timecard (photo_path) "
+                "WHERE photo_path IS NOT NULL"
+            )
+
+            columns = ', '.join(get_table_columns(conn, 'timecard'))
+            conn.execute(
+                "DELETE FROM archive.timecard WHERE id IN "
+                "(SELECT id FROM main.timecard WHERE work_date BETWEEN ? AND ?)",
+                (first_day, last_day)
+            )
+            conn.execute(
+                f"INSERT INTO archive.timecard ({columns}) "
+                f"SELECT {columns} FROM main.timecard WHERE work_date BETWEEN ? AND ?",
+                (first_day, last_day)
+            )
+            result = conn.execute("DELETE FROM main.timecard WHERE work_date BETWEEN ? AND ?", (first_day, last_day))
+            conn.commit()
+            moved[month] = result.rowcount
+            logger.info(f"打刻記録をアーカイブしました: {month} {result.rowcount}件 -> {archive_path(month)}")
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+    return moved
+
+@contextmanager
+def timecard_for_month(conn: sqlite3.Connection, month: int) -> Iterator[str]:
+    """
+    指定月 (YYYYMM) の timecard を参照するテーブル式を返す
+
+    アーカイブ済みの月はアーカイブDBをATTACHし、ホットDBの残りと
+    UNION ALL したサブクエリを返す。アーカイブがなければ 'timecard'。
+    移動途中やスナップショットで両方に存在するIDはホットDB側を優先する。
+    """
+    path = archive_path(month)
+    if not os.path.exists(path):
+        yield 'timecard'
+        return
+
+    alias = f'archive_{month}'
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+    try:
+        archive_columns = {row[1] for row in conn.execute(f"PRAGMA {alias}.table_info(timecard)").fetchall()}
+        main_columns = get_table_columns(conn, 'timecard')
+        archive_select = ', '.join(
+            column if column in archive_columns else f'NULL AS {column}' for column in main_columns
+        )
+        yield (
+            f"(SELECT {', '.join(main_columns)} FROM main.timecard "
+            f"UNION ALL SELECT {archive_select} FROM {alias}.timecard "
+            f"WHERE id NOT IN (SELECT id FROM main.timecard))"
+        )
+    finally:
+        conn.execute(f"DETACH DATABASE {alias}")
+
+# === 打刻書き込みキュー（グループコミット） ===
+
+T = TypeVar('T')
+
+class PunchWriteQueue:
+    """打刻の書き込みを1本のライタースレッドでまとめてコミットするキュー
+
+    各リクエストは書き込み処理（接続を受け取る関数）を投入し、その処理を含む
+    バッチのコミットが完了するまで待つ。バッチは最大 max_rows 件、または
+    最初の投入から max_wait_ms ミリ秒で締め切る。処理ごとにSAVEPOINTを置く
+    ため、1件の失敗が同じバッチの他の打刻を巻き込むことはない。
+    """
+
+    def __init__(self, enabled: bool, max_rows: int, max_wait_ms: int) -> None:
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self._queue: 'queue.Queue[Optional[Tuple[Callable[[sqlite3.Connection], Any], Future]]]' = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, work: Callable[[sqlite3.Connection], T]) -> T:
+        """書き込み処理を投入し、コミット完了後にその戻り値を返す"""
+        self._ensure_started()
+        future: 'Future[T]' = Future()
+        self._queue.put((work, future))
+        return future.result(timeout=PUNCH_COMMIT_TIMEOUT)
+
+    def shutdown(self) -> None:
+        """投入済みの書き込みをすべてコミットしてからライターを停止"""
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=PUNCH_COMMIT_TIMEOUT)
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='punch-writer', daemon=True)
+                self._thread.start()
+
+    def _collect_batch(self) -> Tuple[List[Tuple[Callable[[sqlite3.Connection], Any], Future]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=max(0.0, remaining)) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        conn = get_db_connection()
+        # バッチ単位のコミットで必ずfsyncし、応答済みの打刻を失わない
+        conn.execute("PRAGMA synchronous = FULL")
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = self._collect_batch()
+                if batch:
+                    self._commit_batch(conn, batch)
+        finally:
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection,
+                      batch: List[Tuple[Callable[[sqlite3.Connection], Any], Future]]) -> None:
+        outcomes: List[Tuple[Future, bool, Any]] = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for work, future in batch:
+                conn.execute("SAVEPOINT punch")
+                try:
+                    outcomes.append((future, True, work(conn)))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO punch")
+                    outcomes.append((future, False, e))
+                conn.execute("RELEASE punch")
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            logger.error(f"打刻バッチのコミットエラー（{len(batch)}件）: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        logger.debug(f"打刻バッチをコミットしました: {len(batch)}件")
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+punch_write_queue = PunchWriteQueue(PUNCH_GROUP_COMMIT, PUNCH_BATCH_MAX_ROWS, PUNCH_BATCH_MAX_WAIT_MS)
+atexit.register(punch_write_queue.shutdown)
+
+def commit_punch_write(conn: sqlite3.Connection, work: Callable[[sqlite3.Connection], T]) -> T:
+    """
+    打刻の書き込み処理を実行してコミット
+
+    グループコミット有効時はライタースレッドのバッチに載せ、無効時は
+    呼び出し元の接続で直接実行する。
+    """
+    if punch_write_queue.enabled:
+        return punch_write_queue.submit(work)
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = work(conn)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+
+class PunchRejected(Exception):
+    """打刻トランザクション内の整合性チェックで打刻が拒否された"""
+
+def record_punch(conn: sqlite3.Connection, employee_id: str, action: str, timestamp: datetime,
+                 location: str, photo_path: Optional[str] = None) -> int:
+    """
+    打刻の整合性チェックと登録を1つの BEGIN IMMEDIATE トランザクションで実行
+
+    書き込みロックを取得した状態で当日の打刻を1回だけ読み、検証後に
+    INSERT する。出勤・退勤の重複は部分ユニークインデックスでも拒否される。
+    登録した行のIDを返し、拒否時は PunchRejected を送出する。
+    """
+    work_date = timecard_time_columns(timestamp)[2]
+
+    def work(c: sqlite3.Connection) -> int:
+        state, counts = punch_validator.load_daily_status(c, employee_id, work_date)
+        is_valid, message = punch_validator.evaluate_punch(state, counts, action)
+        if not is_valid:
+            raise PunchRejected(message)
+
+        try:
+            punch_id = insert_timecard(c, employee_id, timestamp, action, location, photo_path)
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' not in str(e):
+                raise
+            raise PunchRejected(punch_validator.get_duplicate_message(action))
+
+        counts[action] = counts.get(action, 0) + 1
+        employee_state_cache.put(employee_id, work_date, apply_punch_action(state, action), counts)
+        return punch_id
+
+    try:
+        return commit_punch_write(conn, work)
+    except PunchRejected:
+        raise
+    except Exception:
+        # コミットに失敗した場合、トランザクション内で更新したキャッシュは信用できない
+        employee_state_cache.invalidate(employee_id)
+        raise
+
+def plan_daily_punches(stored: List[Tuple[int, int, Optional[str]]],
+                       incoming: List[Tuple[int, int, str]]) -> Dict[int, str]:
+    """
+    1人1日分の登録済みの打刻と追加する打刻を時系列に並べ、追加できない打刻を判定
+
+    stored は登録済みの (ts_epoch, id, action)、incoming は追加する (ts_epoch, 番号, action)。
+    時刻順（同時刻は登録済み→追加分の順）に PunchValidator の規則で再生し、
+    その時点の状態で許可されない追加分を除く。追加分によって後ろの登録済みの打刻が
+    整合しなくなる場合は、その直前に採用した追加分を除いて再生し直す。
+    もともと整合していない登録済みの打刻（管理画面での修正など）は問わない。
+    戻り値は {除いた追加分の番号: 理由}。
+    """
+    def replay(excluded: Dict[int, str]) -> Tuple[Dict[int, str], Optional[Tuple[int, int, Optional[str], Optional[int]]]]:
+        merged = sorted([(ts_epoch, 0, key, action) for ts_epoch, key, action in stored] +
+                        [(ts_epoch, 1, key, action) for ts_epoch, key, action in incoming if key not in excluded])
+        state = EmployeeState.NOT_ARRIVED
+        counts: Dict[str, int] = {}
+        rejected: Dict[int, str] = {}
+        last_incoming: Optional[int] = None
+        for ts_epoch, is_incoming, key, action in merged:
+            is_valid, message = punch_validator.evaluate_punch(state, counts, action or '')
+            if not is_valid:
+                if is_incoming:
+                    rejected[key] = message
+                    continue
+                if key not in baseline and last_incoming is not None:
+                    return rejected, (ts_epoch, key, action, last_incoming)
+            if is_incoming:
+                last_incoming = key
+            state = apply_punch_action(state, action)
+            if action:
+                counts[action] = counts.get(action, 0) + 1
+        return rejected, None
+
+    # 追加分がなくても整合しない登録済みの打刻
+    baseline: Set[int] = set()
+    if incoming:
+        state = EmployeeState.NOT_ARRIVED
+        counts: Dict[str, int] = {}
+        for _, key, action in sorted(stored):
+            if not punch_validator.evaluate_punch(state, counts, action or '')[0]:
+                baseline.add(key)
+            state = apply_punch_action(state, action)
+            if action:
+                counts[action] = counts.get(action, 0) + 1
+
+    excluded: Dict[int, str] = {}
+    while True:
+        rejected, conflict = replay(excluded)
+        if conflict is None:
+            return {**rejected, **excluded}
+        ts_epoch, _, action, culprit = conflict
+        later = datetime.fromtimestamp(ts_epoch, JST).strftime('%H:%M')
+        excluded[culprit] = f"{later}の{PUNCH_ACTION_LABELS.get(action or '', action)}打刻と整合しないため登録できません"
+
+def record_punch_batch(conn: sqlite3.Connection, punches: List[Dict[str, Any]],
+                       location: str, device_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    端末に溜まった打刻をまとめて1つのトランザクションで登録
+
+    punches は employee_id / action / timestamp(datetime) / photo_path を持つ辞書の
+    リスト（送信順）。従業員・日付ごとに登録済みの打刻と合わせて時刻順に並べ、
+    各打刻をその時刻の状態で判定する（plan_daily_punches）。結果は送信と同じ順序で返す。
+    同じ従業員・時刻・アクションの記録が既にある打刻は再送とみなし、登録済みとして扱う。
+    登録した行には送信元の device_id を記録する。
+    """
+    def work(c: sqlite3.Connection) -> List[Dict[str, Any]]:
+        results: List[Optional[Dict[str, Any]]] = [None] * len(punches)
+        days: Dict[Tuple[str, int], List[Tuple[int, int, str]]] = {}
+        first_index: Dict[Tuple[str, int, str], int] = {}
+        repeats: List[Tuple[int, int]] = []
+
+        for index, punch in enumerate(punches):
+            employee_id, action = punch['employee_id'], punch['action']
+            _, ts_epoch, work_date = timecard_time_columns(punch['timestamp'])
+
+            # 同じバッチ内で同じ打刻が重複している場合は最初の1件の結果に従う
+            identity = (employee_id, ts_epoch, action)
+            if identity in first_index:
+                repeats.append((index, first_index[identity]))
+                continue
+            first_index[identity] = index
+
+            existing = c.execute(
+                "SELECT id FROM timecard WHERE employee_id = ? AND ts_epoch = ? AND action = ?",
+                (employee_id, ts_epoch, ACTION_CODES[action])
+            ).fetchone()
+            if existing:
+                results[index] = {'success': True, 'id': existing['id'], 'duplicate': True}
+                continue
+            days.setdefault((employee_id, work_date), []).append((ts_epoch, index, action))
+
+        for (employee_id, work_date), incoming in days.items():
+            stored = [
+                (row['ts_epoch'], row['id'], decode_action(row['action']))
+                for row in c.execute(
+                    "SELECT id, ts_epoch, action FROM timecard WHERE employee_id = ? AND work_date = ?",
+                    (employee_id, work_date)
+                )
+            ]
+            rejected = plan_daily_punches(stored, incoming)
+            # 時刻順に INSERT し、同時刻の打刻も判定時と同じ順序（id順）で並ぶようにする
+            for _, index, action in sorted(incoming):
+                if index in rejected:
+                    results[index] = {'success': False, 'message': rejected[index]}
+                    continue
+                punch = punches[index]
+                try:
+                    punch_id = insert_timecard(c, employee_id, punch['timestamp'], action, location,
+                                               punch.get('photo_path'), device_id)
+                except sqlite3.IntegrityError as e:
+                    if 'UNIQUE' not in str(e):
+                        raise
+                    results[index] = {'success': False, 'message': punch_validator.get_duplicate_message(action)}
+                    continue
+                results[index] = {'success': True, 'id': punch_id}
+
+        for index, original in repeats:
+            outcome = dict(results[original] or {})
+            if outcome.get('success'):
+                outcome['duplicate'] = True
+            results[index] = outcome
+        return [result or {} for result in results]
+
+    try:
+        return commit_punch_write(conn, work)
+    finally:
+        # 過去の時刻の打刻は送信順と時刻順が一致しないため、状態はDBから読み直させる
+        for employee_id in {punch['employee_id'] for punch in punches}:
+            employee_state_cache.invalidate(employee_id)
+
+# === 打刻APIの冪等キー ===
+
+class IdempotencyStore:
+    """Idempotency-Key ごとの応答の保存（DBテーブル + 件数上限付きLRU）
+
+    保存期間を過ぎたキーは一定間隔でDBから削除する。同じキーのリクエストが
+    同時に届いた場合は、先に届いた処理の完了を待ってからその応答を返す。
+    """
+
+    def __init__(self, capacity: int, ttl_seconds: int) -> None:
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[int, int, str]]' = OrderedDict()
+        self._in_flight: Dict[str, threading.Event] = {}
+        self._last_pruned = 0.0
+
+    def lookup(self, key: str) -> Optional[Tuple[int, str]]:
+        """保存済みの応答 (ステータスコード, 本文) を取得"""
+        cutoff = int(time.time()) - self.ttl_seconds
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= cutoff:
+                    self._entries.move_to_end(key)
+                    return entry[1], entry[2]
+                del self._entries[key]
+
+        conn = get_db_connection()
+        try:
+            row = conn.execute(
+                "SELECT status_code, response, created_at FROM idempotency_keys WHERE key = ? AND created_at >= ?",
+                (key, cutoff)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        self._remember(key, row['created_at'], row['status_code'], row['response'])
+        return row['status_code'], row['response']
+
+    def _remember(self, key: str, created_at: int, status_code: int, body: str) -> None:
+        with self._lock:
+            self._entries[key] = (created_at, status_code, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def begin(self, key: str) -> Optional[Tuple[int, str]]:
+        """
+        キーの処理を開始
+
+        保存済みの応答があれば (ステータスコード, 本文) を返す。なければ None を返し、
+        呼び出し側は処理後に finish() を必ず呼ぶ。
+        """
+        while True:
+            stored = self.lookup(key)
+            if stored is not None:
+                return stored
+            with self._lock:
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    return None
+            event.wait(IDEMPOTENCY_WAIT_TIMEOUT)
+
+    def finish(self, key: str, status_code: Optional[int] = None, body: Optional[str] = None) -> None:
+        """処理結果を保存（status_code 省略時は保存せず、再送で再実行させる）"""
+        try:
+            if status_code is not None and body is not None:
+                created_at = int(time.time())
+                conn = get_db_connection()
+                try:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO idempotency_keys (key, status_code, response, created_at) VALUES (?, ?, ?, ?)",
+                        (key, status_code, body, created_at)
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._remember(key, created_at, status_code, body)
+                self._prune_if_due()
+        finally:
+            with self._lock:
+                event = self._in_flight.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def _prune_if_due(self) -> None:
+        now = time.time()
+        with self._lock:
+            if now - self._last_pruned < IDEMPOTENCY_PRUNE_INTERVAL:
+                return
+            self._last_pruned = now
+
+        conn = get_db_connection()
+        try:
+            deleted = conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?", (int(now) - self.ttl_seconds,)
+            ).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if deleted:
+            logger.info(f"期限切れの冪等キーを削除しました: {deleted}件")
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL_HOURS * 3600)
+
+def skip_idempotency_record() -> None:
+    """一時的なエラーの応答を冪等キーに保存しない（再送で再実行させる）"""
+    g.idempotency_skip = True
+
+def idempotent(view: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Idempotency-Key ヘッダー付きのリクエストを冪等にするデコレーター
+
+    同じキーの再送には、検証・写真保存・登録を行わずに最初の応答をそのまま返す。
+    """
+    @wraps(view)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        raw_key = request.headers.get('Idempotency-Key', '').strip()
+        if not raw_key:
+            return view(*args, **kwargs)
+        if len(raw_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'success': False, 'message': 'Idempotency-Key が長すぎます'}), 400
+
+        key = f"{request.path}:{raw_key}"
+        stored = idempotency_store.begin(key)
+        if stored is not None:
+            logger.info(f"冪等キーの再送を検出し、保存済みの応答を返します: {raw_key}")
+            return Response(stored[1], status=stored[0], mimetype='application/json',
+                            headers={'Idempotent-Replayed': 'true'})
+
+        status_code: Optional[int] = None
+        body: Optional[str] = None
+        try:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code < 500 and not g.get('idempotency_skip'):
+                status_code, body = response.status_code, response.get_data(as_text=True)
+            return response
+        finally:
+            idempotency_store.finish(key, status_code, body)
+
+    return wrapper
+
+# === レポート用スナップショット ===
+
+class ReportSnapshot:
+    """エクスポート・集計用の読み取り専用スナップショットDB
+
+    sqlite3 のバックアップAPIで timecard.db を定期的に複製し、長時間の
+    読み取りが打刻の書き込みと競合しないようにする。
     """
-    # パス設定（OSに応じて変更）
-    if os.name == 'posix':  # Linux/Unix (Azure)
-        persistent_storage_path = '/home'
-    else:  # Windows
-        persistent_storage_path = os.path.dirname(os.path.abspath(__file__))
 
-    db_path = os.path.join(persistent_storage_path, 'timecard.db')
+    def __init__(self, source_path: str, snapshot_path: str, max_age: int) -> None:
+        self.source_path = source_path
+        self.snapshot_path = snapshot_path
+        self.max_age = max_age
+        self.taken_at: Optional[float] = None
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age > 0
+
+    def age_seconds(self) -> Optional[float]:
+        if self.taken_at is None:
+            return None
+        return max(0.0, time.time() - self.taken_at)
+
+    def refresh(self) -> None:
+        """スナップショットを作り直す（同時実行時は先行する更新の完了を待つ）"""
+        with self._refresh_lock:
+            started_at = time.time()
+            temp_path = f"{self.snapshot_path}.tmp"
+            source = sqlite3.connect(self.source_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+            target = sqlite3.connect(temp_path)
+            try:
+                # ページ単位で少しずつ複製し、書き込み側にロックを譲る
+                source.backup(target, pages=REPORT_SNAPSHOT_BACKUP_PAGES)
+                # 読み取り専用で開けるよう、WALではなく通常のジャーナルにする
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+                source.close()
+
+            os.replace(temp_path, self.snapshot_path)
+            self.taken_at = started_at
+            logger.info(f"レポート用スナップショットを更新しました（{time.time() - started_at:.2f}秒）")
+
+    def connect(self) -> sqlite3.Connection:
+        """スナップショットへの読み取り専用接続を取得（古ければ先に更新）"""
+        if self.taken_at is None and os.path.exists(self.snapshot_path):
+            self.taken_at = os.path.getmtime(self.snapshot_path)
+
+        age = self.age_seconds()
+        if age is None or age > self.max_age:
+            self.refresh()
+
+        conn = sqlite3.connect(f"{Path(self.snapshot_path).as_uri()}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        register_sql_functions(conn)
+        return conn
+
+    def start(self) -> None:
+        """バックグラウンドでの定期更新を開始"""
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name='report-snapshot', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"レポート用スナップショット更新エラー: {e}")
+            self._stop_event.wait(self.max_age)
 
-    logger.info(f"データベース接続を試行します: {db_path}")
 
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+report_snapshot = ReportSnapshot(DB_PATH, REPORT_SNAPSHOT_PATH, REPORT_SNAPSHOT_MAX_AGE)
 
-    # 外部キー制約を有効化
-    conn.execute("PRAGMA foreign_keys = ON")
+def get_report_connection() -> sqlite3.Connection:
+    """
+    エクスポート・集計用の接続を取得
 
+    スナップショットが有効な場合は読み取り専用の複製を返し、
+    データ時点をレスポンスヘッダーで通知する。
+    """
+    if not report_snapshot.enabled:
+        return get_db_connection()
+
+    conn = report_snapshot.connect()
+    g.report_snapshot_taken_at = report_snapshot.taken_at
     return conn
 
+@app.after_request
+def add_report_snapshot_headers(response: Response) -> Response:
+    """スナップショットから生成したレスポンスにデータ時点を付与"""
+    taken_at = g.get('report_snapshot_taken_at')
+    if taken_at is not None:
+        response.headers['X-Data-As-Of'] = datetime.fromtimestamp(taken_at, JST).isoformat()
+        response.headers['X-Data-Age-Seconds'] = str(int(max(0.0, time.time() - taken_at)))
+    return response
+
 def send_reset_email(reset_url: str, admin_email: str) -> bool:
     """パスワードリセット用URLをメール送信"""
     try:
@@ -292,6 +1428,282 @@ def send_reset_email(reset_url: str, admin_email: str) -> bool:
         logger.error(f"メール送信エラー: {e}")
         return False
 
+# === スキーマ移行（マイグレーション） ===
+
+SchemaMigration = Tuple[int, str, Callable[[sqlite3.Connection], None]]
+
+# バージョン順に並んだマイグレーション一覧（schema_migration デコレーターで登録）
+SCHEMA_MIGRATIONS: List[SchemaMigration] = []
+
+def schema_migration(version: int, description: str) -> Callable[[Callable[[sqlite3.Connection], None]], Callable[[sqlite3.Connection], None]]:
+    """マイグレーション関数を登録するデコレーター"""
+    def decorator(func: Callable[[sqlite3.Connection], None]) -> Callable[[sqlite3.Connection], None]:
+        if SCHEMA_MIGRATIONS and SCHEMA_MIGRATIONS[-1][0] >= version:
+            raise ValueError(f"マイグレーションのバージョンは昇順で登録してください: {version}")
+        SCHEMA_MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def get_table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """テーブルの列名一覧を取得"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+@schema_migration(1, 'timecard.break_type 列を追加')
+def _migrate_add_break_type(conn: sqlite3.Connection) -> None:
+    # 旧 migrate_db.py で行っていた列追加（新規DBでは既に存在する）
+    if 'break_type' not in get_table_columns(conn, 'timecard'):
+        conn.execute("ALTER TABLE timecard ADD COLUMN break_type TEXT")
+
+@schema_migration(2, 'timecard の従業員・日時インデックスを追加')
+def _migrate_timecard_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_employee_timestamp ON timecard (employee_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_timestamp ON timecard (timestamp)")
+
+@schema_migration(3, 'users.reset_token インデックスを追加')
+def _migrate_users_reset_token_index(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reset_token ON users (reset_token)")
+
+@schema_migration(4, 'timecard に ts_epoch / work_date 列を追加し、action / location を整数コード化')
+def _migrate_compact_timecard(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP INDEX IF EXISTS idx_timecard_employee_timestamp")
+    conn.execute("DROP INDEX IF EXISTS idx_timecard_timestamp")
+
+    if 'ts_epoch' not in get_table_columns(conn, 'timecard'):
+        conn.execute('''
+            CREATE TABLE timecard_compact (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                employee_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                ts_epoch INTEGER NOT NULL,
+                work_date INTEGER NOT NULL,
+                action INTEGER NOT NULL,
+                photo_path TEXT,
+                location INTEGER,
+                break_type TEXT,
+                FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
+            )
+        ''')
+
+        cursor = conn.execute(
+            "SELECT id, employee_id, timestamp, action, photo_path, location, break_type FROM timecard ORDER BY id"
+        )
+        # 変換できないタイムスタンプの記録は timecard_unparsed へ退避する
+        conn.execute("CREATE TABLE IF NOT EXISTS timecard_unparsed AS SELECT * FROM timecard WHERE 0")
+        unknown_actions = 0
+        unknown_locations = 0
+        unparsed_ids: List[int] = []
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            converted = []
+            for row in rows:
+                timestamp = parse_legacy_timestamp(row['timestamp'])
+                if timestamp is None:
+                    unparsed_ids.append(row['id'])
+                    continue
+                timestamp_str, ts_epoch, work_date = timecard_time_columns(timestamp)
+                action_code = ACTION_CODES.get(row['action'], UNKNOWN_ACTION_CODE)
+                if action_code == UNKNOWN_ACTION_CODE:
+                    unknown_actions += 1
+                location_code = LOCATION_CODES.get(row['location'])
+                if row['location'] and location_code is None:
+                    unknown_locations += 1
+                converted.append((
+                    row['id'], row['employee_id'], timestamp_str, ts_epoch, work_date,
+                    action_code, row['photo_path'], location_code, row['break_type']
+                ))
+            conn.executemany('''
+                INSERT INTO timecard_compact
+                    (id, employee_id, timestamp, ts_epoch, work_date, action, photo_path, location, break_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', converted)
+
+        for punch_id in unparsed_ids:
+            conn.execute("INSERT INTO timecard_unparsed SELECT * FROM timecard WHERE id = ?", (punch_id,))
+        if unparsed_ids:
+            logger.warning(f"タイムスタンプを変換できない打刻記録{len(unparsed_ids)}件を timecard_unparsed へ退避しました")
+        if unknown_actions:
+            logger.warning(f"未知のアクションを持つ打刻記録が{unknown_actions}件あります（コード{UNKNOWN_ACTION_CODE}で保存）")
+        if unknown_locations:
+            logger.warning(f"未知の打刻場所を持つ打刻記録が{unknown_locations}件あります（場所は空欄になります）")
+
+        conn.execute("DROP TABLE timecard")
+        conn.execute("ALTER TABLE timecard_compact RENAME TO timecard")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_employee_date ON timecard (employee_id, work_date, ts_epoch)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_work_date ON timecard (work_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_ts_epoch ON timecard (ts_epoch)")
+
+@schema_migration(5, '出勤・退勤の1日1回を保証する部分ユニークインデックスを追加')
+def _migrate_unique_daily_in_out(conn: sqlite3.Connection) -> None:
+    in_out_codes = (ACTION_CODES['in'], ACTION_CODES['out'])
+
+    # 既存の重複は timecard_duplicates へ退避する（出勤は最初、退勤は最後の記録を残す）
+    conn.execute("CREATE TABLE IF NOT EXISTS timecard_duplicates AS SELECT * FROM timecard WHERE 0")
+    groups = conn.execute('''
+        SELECT employee_id, work_date, action FROM timecard
+        WHERE action IN (?, ?)
+        GROUP BY employee_id, work_date, action
+        HAVING COUNT(*) > 1
+    ''', in_out_codes).fetchall()
+
+    duplicate_ids: List[int] = []
+    for group in groups:
+        ids = [row['id'] for row in conn.execute('''
+            SELECT id FROM timecard
+            WHERE employee_id = ? AND work_date = ? AND action = ?
+            ORDER BY ts_epoch ASC, id ASC
+        ''', (group['employee_id'], group['work_date'], group['action'])).fetchall()]
+        keep_id = ids[0] if group['action'] == ACTION_CODES['in'] else ids[-1]
+        duplicate_ids.extend(punch_id for punch_id in ids if punch_id != keep_id)
+
+    for punch_id in duplicate_ids:
+        conn.execute("INSERT INTO timecard_duplicates SELECT * FROM timecard WHERE id = ?", (punch_id,))
+        conn.execute("DELETE FROM timecard WHERE id = ?", (punch_id,))
+    if duplicate_ids:
+        logger.warning(f"重複した出勤・退勤記録{len(duplicate_ids)}件を timecard_duplicates へ退避しました")
+
+    conn.execute(f'''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_timecard_daily_in_out
+        ON timecard (employee_id, work_date, action)
+        WHERE action IN ({in_out_codes[0]}, {in_out_codes[1]})
+    ''')
+
+@schema_migration(6, '打刻APIの冪等キー保存テーブルを追加')
+def _migrate_idempotency_keys(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            status_code INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at)")
+
+@schema_migration(7, '写真メンテナンス用の photo_path インデックスと進捗テーブルを追加')
+def _migrate_photo_maintenance(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_timecard_photo_path ON timecard (photo_path) WHERE photo_path IS NOT NULL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+@schema_migration(8, 'face_data.face_descriptor をカンマ区切りTEXTから float32 のBLOBに変換')
+def _migrate_face_descriptor_blob(conn: sqlite3.Connection) -> None:
+    declared = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(face_data)").fetchall()}
+    if declared.get('face_descriptor', '').upper() != 'BLOB':
+        # 列の型を変更するためテーブルを作り直す
+        conn.execute('''
+            CREATE TABLE face_data_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                employee_id TEXT UNIQUE NOT NULL,
+                face_descriptor BLOB NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
+            )
+        ''')
+        conn.execute('''
+            INSERT INTO face_data_new (id, employee_id, face_descriptor, created_at, updated_at)
+            SELECT id, employee_id, face_descriptor, created_at, updated_at FROM face_data
+        ''')
+        conn.execute("DROP TABLE face_data")
+        conn.execute("ALTER TABLE face_data_new RENAME TO face_data")
+
+    rows = conn.execute("SELECT id, employee_id, face_descriptor FROM face_data WHERE typeof(face_descriptor) = 'text'").fetchall()
+    for row in rows:
+        try:
+            blob = encode_face_descriptor([float(x) for x in row['face_descriptor'].split(',')])
+        except ValueError:
+            # 照合に使えないデータは削除し、再登録してもらう
+            logger.warning(f"不正な顔データを削除しました（再登録が必要）: {row['employee_id']}")
+            conn.execute("DELETE FROM face_data WHERE id = ?", (row['id'],))
+            continue
+        conn.execute("UPDATE face_data SET face_descriptor = ? WHERE id = ?", (blob, row['id']))
+
+@schema_migration(9, '打刻端末（キオスク）の登録テーブルを追加し、timecard に device_id 列を追加')
+def _migrate_kiosk_devices(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS kiosk_devices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            token_hash TEXT UNIQUE NOT NULL,
+            created_at TEXT NOT NULL,
+            revoked_at TEXT
+        )
+    ''')
+    if 'device_id' not in get_table_columns(conn, 'timecard'):
+        conn.execute("ALTER TABLE timecard ADD COLUMN device_id TEXT")
+
+@schema_migration(10, 'face_data に登録時の写真の photo_path 列を追加')
+def _migrate_face_photo_path(conn: sqlite3.Connection) -> None:
+    if 'photo_path' not in get_table_columns(conn, 'face_data'):
+        conn.execute("ALTER TABLE face_data ADD COLUMN photo_path TEXT")
+
+def ensure_schema_version_table(conn: sqlite3.Connection) -> None:
+    """スキーマバージョン管理テーブルを作成"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """適用済みの最新スキーマバージョンを取得（未管理のDBは0）"""
+    table = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ).fetchone()
+    if not table:
+        return 0
+    row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+    return row['version'] or 0
+
+def get_pending_migrations(conn: sqlite3.Connection) -> List[SchemaMigration]:
+    """未適用のマイグレーション一覧を取得"""
+    current_version = get_schema_version(conn)
+    return [migration for migration in SCHEMA_MIGRATIONS if migration[0] > current_version]
+
+def apply_schema_migrations(conn: sqlite3.Connection) -> List[int]:
+    """未適用のマイグレーションを順番に適用し、適用したバージョン一覧を返す"""
+    if conn.in_transaction:
+        conn.commit()
+    ensure_schema_version_table(conn)
+
+    applied: List[int] = []
+    for version, description, migrate in get_pending_migrations(conn):
+        # 複数プロセスの同時起動に備え、書き込みロック取得後に再確認する
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+
+            logger.info(f"マイグレーション適用中: v{version} {description}")
+            migrate(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now(JST).isoformat())
+            )
+            conn.commit()
+            applied.append(version)
+        except Exception:
+            conn.rollback()
+            logger.error(f"マイグレーション失敗: v{version} {description}")
+            raise
+
+    if applied:
+        conn.execute("PRAGMA optimize")
+        logger.info(f"マイグレーション完了: スキーマバージョン v{applied[-1]}")
+    return applied
+
 def init_db() -> None:
     """データベース初期化（修正版）"""
     conn = None
@@ -316,9 +1728,11 @@ def init_db() -> None:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 employee_id TEXT NOT NULL,
                 timestamp TEXT NOT NULL,
-                action TEXT NOT NULL,
+                ts_epoch INTEGER NOT NULL,
+                work_date INTEGER NOT NULL,
+                action INTEGER NOT NULL,
                 photo_path TEXT,
-                location TEXT,
+                location INTEGER,
                 break_type TEXT,
                 FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
             )
@@ -341,13 +1755,17 @@ def init_db() -> None:
             CREATE TABLE IF NOT EXISTS face_data (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 employee_id TEXT UNIQUE NOT NULL,
-                face_descriptor TEXT NOT NULL,
+                face_descriptor BLOB NOT NULL,
                 created_at TEXT NOT NULL,
                 updated_at TEXT NOT NULL,
                 FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
             )
         ''')
         
+        # スキーマ移行（インデックス追加など）
+        apply_schema_migrations(conn)
+        clear_pending_photos(conn)
+
         # デフォルト管理者ユーザー作成（セキュアなパスワード）
         admin_user = c.execute("SELECT * FROM users WHERE username = 'admin'").fetchone()
         if not admin_user:
@@ -370,6 +1788,7 @@ def init_db() -> None:
             logger.info("テスト用従業員を追加しました: TEST001")
 
         conn.commit()
+        employee_directory.bump()
         logger.info("データベース初期化完了")
 
     except Exception as e:
@@ -401,13 +1820,12 @@ def init_db() -> None:
         logger.info(f"  - QRフォルダ: {qr_folder}")
         logger.info(f"  - 写真フォルダ: {photo_folder}")
 
-        # テスト用QRコード生成
-        generate_qr_code('TEST001')
-        logger.info("テスト用QRコードを生成しました")
-
     except Exception as e:
         logger.error(f"ディレクトリ作成エラー: {e}")
 
+    # レポート用スナップショットの定期更新を開始
+    report_snapshot.start()
+
 class User(UserMixin):
     def __init__(self, id: int) -> None:
         self.id = id
@@ -421,52 +1839,697 @@ def load_user(user_id: str) -> Optional[User]:
         return User(user_data['id'])
     return None
 
-def generate_qr_code(employee_id: str) -> None:
-    """QRコード生成"""
-    img = qrcode.make(employee_id)
-    qr_path = os.path.join(app.config['QR_FOLDER'], f'{employee_id}.png')
-    img.save(qr_path)
+def render_qr_code(employee_id: str, fmt: str = 'png', scale: int = QR_DEFAULT_SCALE,
+                   error_correction: str = 'M') -> Tuple[bytes, str]:
+    """
+    従業員IDのQRコードを生成し、(画像データ, ETag) を返す
 
-def save_photo(photo_data: str, employee_id: str) -> Optional[str]:
-    """写真保存機能（強化版）"""
+    内容は引数だけで決まるため、直近 QR_CACHE_SIZE 件をメモリにキャッシュする。
+    """
+    # lru_cache は省略・キーワード指定の有無で別のキーになるため、常に全引数を位置引数で渡す
+    return _render_qr_code(employee_id, fmt, scale, error_correction)
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _render_qr_code(employee_id: str, fmt: str, scale: int, error_correction: str) -> Tuple[bytes, str]:
+    qr = qrcode.QRCode(error_correction=QR_ERROR_CORRECTION_LEVELS[error_correction], box_size=scale, border=4)
+    qr.add_data(employee_id)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    if fmt == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    else:
+        qr.make_image().save(buffer)
+    data = buffer.getvalue()
+    return data, hashlib.sha256(data).hexdigest()[:PHOTO_HASH_LENGTH]
+
+def insert_timecard(conn: sqlite3.Connection, employee_id: str, timestamp: datetime, action: str,
+                    location: str, photo_path: Optional[str] = None, device_id: Optional[str] = None) -> int:
+    """
+    打刻記録を追加し、追加した行のIDを返す（コミットは呼び出し側で行う）
+
+    device_id は登録済みの打刻端末から送られた打刻の場合に、監査用として記録する。
+    """
+    timestamp_str, ts_epoch, work_date = timecard_time_columns(timestamp)
+    cursor = conn.execute("""
+        INSERT INTO timecard (employee_id, timestamp, ts_epoch, work_date, action, photo_path, location, device_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (employee_id, timestamp_str, ts_epoch, work_date, ACTION_CODES[action], photo_path,
+          LOCATION_CODES[location], device_id))
+    return int(cursor.lastrowid or 0)
+
+# === 写真の保存形式 ===
+# 写真は PHOTO_FOLDER/YYYY/MM/DD/<内容のSHA-256>.jpg に日付別で保存する。
+# DBの photo_path は 'static/photos/YYYY/MM/DD/<hash>.jpg'、serve_photo の URL も同じ構成。
+# 以下の「写真キー」は PHOTO_FOLDER からの相対パス（旧形式のファイルはファイル名のみ）。
+
+def photo_key(photo_path: str) -> str:
+    """photo_path（'static/photos/...'）から写真キーを取り出す"""
+    path = photo_path.lstrip('/')
+    if path.startswith(PHOTO_PATH_PREFIX):
+        return path[len(PHOTO_PATH_PREFIX):]
+    return os.path.basename(path)
+
+def resolve_photo_file(key: str) -> Optional[str]:
+    """写真キーを PHOTO_FOLDER 内の実ファイルパスに変換（不正なキーは None）"""
+    if os.path.splitext(key)[1].lower() not in PHOTO_EXTENSIONS or key.startswith('variants/'):
+        return None
+    # パストラバーサル防止
+    return safe_join(app.config['PHOTO_FOLDER'], key)
+
+# 内容ハッシュ名の写真キー（YYYY/MM/DD/<hash>.ext）
+CONTENT_ADDRESSED_PHOTO_KEY = re.compile(rf'^\d{{4}}/\d{{2}}/\d{{2}}/([0-9a-f]{{{PHOTO_HASH_LENGTH}}})\.[a-z]+$')
+
+@lru_cache(maxsize=1024)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    """ファイル内容の SHA-256（パス・更新日時・サイズが同じ間はキャッシュ）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(PHOTO_UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def send_cached_file(path: str, mimetype: str, etag: Optional[str] = None,
+                     immutable: bool = False, private: bool = False,
+                     content_encoding: Optional[str] = None) -> Response:
+    """
+    ファイルを検証子（強いETag・Last-Modified）付きで配信
+
+    If-None-Match / If-Modified-Since には 304、Range には 206 で応答する。
+    etag 省略時はファイル内容のハッシュを使う。immutable=True は内容ハッシュ名の
+    ファイル用で、再検証なしの長期キャッシュを許可する。それ以外は毎回再検証させる。
+    STATIC_SENDFILE が設定されていれば、本体の送信はフロントのプロキシに任せる。
+    content_encoding は圧縮済みファイル（.gz / .br）を送る場合に指定する。
+    """
+    stat = os.stat(path)
+    if etag is None:
+        etag = _file_digest(path, stat.st_mtime_ns, stat.st_size)[:PHOTO_HASH_LENGTH]
+    
+    relative = os.path.relpath(path, PERSISTENT_STORAGE_PATH)
+    # 圧縮済みファイルは Content-Encoding がプロキシで落とされうるため自分で送る
+    if STATIC_SENDFILE == 'x-accel-redirect' and not relative.startswith('..') and not content_encoding:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = STATIC_ACCEL_PREFIX + relative.replace(os.sep, '/')
+    elif STATIC_SENDFILE == 'x-sendfile' and not content_encoding:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_file(path, mimetype=mimetype, etag=etag, last_modified=stat.st_mtime, conditional=True)
+        if content_encoding:
+            response.content_encoding = content_encoding
+            response.vary.add('Accept-Encoding')
+        return _with_cache_control(response, immutable, private)
+    
+    # 本体と Range はプロキシが処理する。条件付きリクエストの 304 だけここで返す
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(stat.st_mtime, pytz.utc)
+    response.make_conditional(request)
+    return _with_cache_control(response, immutable, private)
+
+def _with_cache_control(response: Response, immutable: bool, private: bool) -> Response:
+    """send_cached_file の Cache-Control を設定"""
+    cache_control = response.cache_control
+    cache_control.public = not private
+    cache_control.private = private or None
+    if immutable:
+        cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        cache_control.immutable = True
+        cache_control.no_cache = None
+    else:
+        cache_control.max_age = 0
+        cache_control.no_cache = True
+    return response
+
+def discard_photo(photo_path: Optional[str]) -> None:
+    """登録されなかった打刻の写真ファイルを削除"""
+    if not photo_path:
+        return
     try:
-        if not photo_data:
-            return None
-            
-        # Base64データから画像データを抽出
-        if ',' in photo_data:
-            img_data = base64.b64decode(photo_data.split(',')[1])
-        else:
-            img_data = base64.b64decode(photo_data)
-        
-        # PIL Imageで画像を開く
-        img = Image.open(io.BytesIO(img_data))
+        os.remove(os.path.join(PERSISTENT_STORAGE_PATH, photo_path))
+    except OSError as e:
+        logger.warning(f"写真ファイルの削除に失敗: {photo_path} ({e})")
+    for size in PHOTO_VARIANT_SIZES:
+        variant_path = photo_variant_path(photo_key(photo_path), size)
+        if os.path.exists(variant_path):
+            os.remove(variant_path)
+
+# 受信した写真: (一時ファイル, 内容のSHA-256)
+SpooledPhoto = Tuple[IO[bytes], str]
+
+def decode_photo_data(photo_data: str) -> bytes:
+    """Base64（data URL可）の写真データをバイト列に変換"""
+    if ',' in photo_data:
+        return base64.b64decode(photo_data.split(',')[1])
+    return base64.b64decode(photo_data)
+
+def iter_stream(stream: IO[bytes]) -> Iterator[bytes]:
+    """ストリームを PHOTO_UPLOAD_CHUNK_SIZE ごとに読み出す"""
+    while True:
+        chunk = stream.read(PHOTO_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def spool_photo(chunks: Iterable[bytes]) -> SpooledPhoto:
+    """
+    写真データを一時ファイルへ書き出しながらハッシュを計算
+
+    PHOTO_SPOOL_MAX_MEMORY までメモリ上に置き、超えた分はディスクへ退避する。
+    空のデータや MAX_PHOTO_SIZE を超えるデータは ValueError。
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=PHOTO_SPOOL_MAX_MEMORY)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_PHOTO_SIZE:
+            spool.close()
+            raise ValueError('写真のサイズが大きすぎます')
+        digest.update(chunk)
+        spool.write(chunk)
+    if size == 0:
+        spool.close()
+        raise ValueError('写真データが空です')
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+def parse_form_fields(fields: Mapping[str, str]) -> Dict[str, Any]:
+    """フォーム・クエリ文字列の項目を JSON リクエストと同じ型に変換"""
+    data: Dict[str, Any] = dict(fields)
+    if 'face_verified' in data:
+        data['face_verified'] = str(data['face_verified']).lower() in ('1', 'true', 'on')
+    if 'face_similarity' in data:
+        try:
+            data['face_similarity'] = float(data['face_similarity'])
+        except ValueError:
+            data['face_similarity'] = 0
+    if 'face_descriptor' in data:
+        try:
+            data['face_descriptor'] = json.loads(data['face_descriptor'])
+        except ValueError:
+            data['face_descriptor'] = None
+    return data
+
+def read_photo_request() -> Tuple[Optional[Dict[str, Any]], Optional[SpooledPhoto], bool]:
+    """
+    打刻・顔データ登録リクエストから (項目, 写真, 写真が送信されたか) を取り出す
+
+    - application/json: 従来形式（photo は Base64 文字列）
+    - multipart/form-data: 各項目はフォーム値、写真は 'photo' ファイル
+    - image/*: 本文が写真、各項目はクエリ文字列
+    写真が不正な場合は警告を記録し、写真なしとして扱う。
+    """
+    data: Optional[Dict[str, Any]] = None
+    try:
+        if request.mimetype == 'multipart/form-data':
+            data = parse_form_fields(request.form)
+            upload = request.files.get('photo')
+            if not upload:
+                return data, None, False
+            return data, spool_photo(iter_stream(upload.stream)), True
         
-        # ファイル名生成
-        now = datetime.now(JST)
-        photo_filename = f"{employee_id}_{now.strftime('%Y%m%d_%H%M%S')}.jpg"
+        if request.mimetype.startswith('image/'):
+            data = parse_form_fields(request.args)
+            return data, spool_photo(iter_stream(request.stream)), True
         
-        # 保存ディレクトリ確認・作成
-        photo_dir = app.config['PHOTO_FOLDER']
-        os.makedirs(photo_dir, exist_ok=True)
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return None, None, False
+        photo_data = data.pop('photo', None)
+        if not photo_data:
+            return data, None, False
+        return data, spool_photo([decode_photo_data(photo_data)]), True
+    except ValueError as e:
+        logger.warning(f"写真データの読み込みに失敗: {e}")
+        return data, None, True
+
+def photo_relative_path(digest: str, timestamp: datetime, ext: str = '.jpg') -> str:
+    """写真のデータベース用相対パスを生成（撮影日別のディレクトリ + 内容のハッシュ）"""
+    return f"{PHOTO_PATH_PREFIX}{timestamp.astimezone(JST).strftime('%Y/%m/%d')}/{digest[:PHOTO_HASH_LENGTH]}{ext}"
+
+def write_photo(source: IO[bytes], relative_path: str) -> None:
+    """画像をJPEGに変換して保存（失敗時は例外を送出）"""
+    # PIL Imageで画像を開く
+    img = Image.open(source)
+    
+    # 長辺を PHOTO_MAX_DIMENSION までに縮小
+    # JPEGはデコード時に 1/2〜1/8 へ縮小させ（draft）、フル解像度の画素を展開しない
+    max_size = (PHOTO_MAX_DIMENSION, PHOTO_MAX_DIMENSION)
+    if img.format == 'JPEG':
+        img.draft('RGB', max_size)
+    if max(img.size) > PHOTO_MAX_DIMENSION:
+        img.thumbnail(max_size)
+    
+    # 保存ディレクトリ確認・作成
+    full_path = os.path.join(PERSISTENT_STORAGE_PATH, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    
+    # 画像をJPEG形式で保存
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # 透明度がある画像の場合は白背景で合成
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        mask = img.split()[-1] if img.mode == 'RGBA' else None
+        background.paste(img, mask=mask)
+        img = background
+    
+    # 同じ内容の写真が同時に保存されても壊れないよう、一時ファイル経由で置き換える
+    temp_path = f"{full_path}.{threading.get_ident()}.tmp"
+    img.save(temp_path, 'JPEG', quality=85)
+    os.replace(temp_path, full_path)
+    
+    # 一覧表示用の縮小版も同時に作成
+    key = photo_key(relative_path)
+    for size in PHOTO_VARIANT_SIZES:
+        save_photo_variant(img, key, size)
+
+def photo_variant_path(key: str, size: str) -> str:
+    """縮小版写真の保存先（PHOTO_FOLDER/variants/<size>/<写真キー>）"""
+    return os.path.join(app.config['PHOTO_FOLDER'], 'variants', size, key)
+
+def save_photo_variant(img: Image.Image, key: str, size: str) -> str:
+    """画像から指定サイズの縮小版を作成して保存し、保存先を返す"""
+    max_edge = PHOTO_VARIANT_SIZES[size]
+    variant = img.copy()
+    variant.thumbnail((max_edge, max_edge))
+    if variant.mode != 'RGB':
+        variant = variant.convert('RGB')
+    
+    path = photo_variant_path(key, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 同時リクエストで作成中のファイルを配信しないよう、一時ファイル経由で置き換える
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    variant.save(temp_path, 'JPEG', quality=PHOTO_VARIANT_QUALITY)
+    os.replace(temp_path, path)
+    return path
+
+def ensure_photo_variant(original_path: str, key: str, size: str) -> str:
+    """縮小版写真のパスを返す（未作成の場合は元画像から作成してキャッシュ）"""
+    path = photo_variant_path(key, size)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(original_path):
+        return path
+    with Image.open(original_path) as img:
+        return save_photo_variant(img, key, size)
+
+def photo_databases() -> List[Optional[str]]:
+    """写真を参照しうるDBの一覧（None はホットDB、以降は月別アーカイブDBのパス）"""
+    if not os.path.isdir(ARCHIVE_FOLDER):
+        return [None]
+    return [None] + sorted(
+        os.path.join(ARCHIVE_FOLDER, name) for name in os.listdir(ARCHIVE_FOLDER)
+        if name.startswith('timecard_') and name.endswith('.db')
+    )
+
+def migrate_flat_photos(conn: sqlite3.Connection, dry_run: bool = False,
+                        chunk_size: int = 500) -> Dict[str, int]:
+    """
+    旧形式（PHOTO_FOLDER 直下）の写真を日付別・ハッシュ名の保存形式へ移動
+
+    chunk_size 件ごとに、ホットDBと月別アーカイブDBの photo_path を先に更新してから
+    ファイルを移動する。途中で中断しても、再実行すれば同じ移動先で続きから処理できる。
+    """
+    photo_folder = app.config['PHOTO_FOLDER']
+    legacy_name = re.compile(r'_(\d{8})_\d{6}')
+    result = {'files': 0, 'rows': 0}
+    if not os.path.isdir(photo_folder):
+        return result
+
+    databases = photo_databases()
+
+    def pending_chunks() -> Iterator[List[Tuple[str, str]]]:
+        chunk: List[Tuple[str, str]] = []
+        with os.scandir(photo_folder) as entries:
+            for entry in entries:
+                ext = os.path.splitext(entry.name)[1].lower()
+                if not entry.is_file() or ext not in PHOTO_EXTENSIONS:
+                    continue
+                with open(entry.path, 'rb') as f:
+                    data = f.read()
+                # 撮影日はファイル名（{employee_id}_{YYYYmmdd_HHMMSS}）から、なければ更新日時から
+                match = legacy_name.search(entry.name)
+                if match:
+                    taken = JST.localize(datetime.strptime(match.group(1), '%Y%m%d'))
+                else:
+                    taken = datetime.fromtimestamp(entry.stat().st_mtime, JST)
+                chunk.append((entry.name, photo_relative_path(hashlib.sha256(data).hexdigest(), taken, ext)))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    if conn.in_transaction:
+        conn.commit()
+    for chunk in pending_chunks():
+        updates = [
+            (new_path, old_form)
+            for name, new_path in chunk
+            for old_form in (f"{PHOTO_PATH_PREFIX}{name}", f"/{PHOTO_PATH_PREFIX}{name}", name)
+        ]
+        for database in databases:
+            if dry_run:
+                break
+            if database:
+                conn.execute("ATTACH DATABASE ? AS photo_archive", (database,))
+            try:
+                table = 'photo_archive.timecard' if database else 'main.timecard'
+                conn.execute("BEGIN IMMEDIATE")
+                for new_path, old_form in updates:
+                    result['rows'] += conn.execute(
+                        f"UPDATE {table} SET photo_path = ? WHERE photo_path = ?", (new_path, old_form)
+                    ).rowcount
+                conn.commit()
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                if database:
+                    conn.execute("DETACH DATABASE photo_archive")
+
+        for name, new_path in chunk:
+            result['files'] += 1
+            if dry_run:
+                continue
+            source = os.path.join(photo_folder, name)
+            destination = os.path.join(PERSISTENT_STORAGE_PATH, new_path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(source, destination)
+            # 旧形式の縮小版は次回要求時に新しいキーで作り直す
+            for size in PHOTO_VARIANT_SIZES:
+                variant_path = photo_variant_path(name, size)
+                if os.path.exists(variant_path):
+                    os.remove(variant_path)
+        logger.info(f"写真の保存形式を移行中: {result['files']}件")
+
+    return result
+
+# === 写真のメンテナンス ===
+# 保存期間を過ぎた写真の削除、古い写真の再圧縮、DBとディスクの突き合わせを行う。
+# 進捗は maintenance_state に保存し、中断しても再実行で続きから処理する。
+
+def get_maintenance_state(conn: sqlite3.Connection, name: str) -> Optional[str]:
+    """メンテナンス処理の進捗を取得"""
+    row = conn.execute("SELECT value FROM maintenance_state WHERE name = ?", (name,)).fetchone()
+    return row['value'] if row else None
+
+def set_maintenance_state(conn: sqlite3.Connection, name: str, value: Optional[str]) -> None:
+    """メンテナンス処理の進捗を保存（None は削除）。コミットは呼び出し側で行う"""
+    if value is None:
+        conn.execute("DELETE FROM maintenance_state WHERE name = ?", (name,))
+    else:
+        conn.execute(
+            "INSERT OR REPLACE INTO maintenance_state (name, value, updated_at) VALUES (?, ?, ?)",
+            (name, value, datetime.now(JST).isoformat())
+        )
+
+@contextmanager
+def attached_timecard(conn: sqlite3.Connection, database: Optional[str],
+                      create_index: bool = False) -> Iterator[str]:
+    """photo_databases() の1件を開き、その timecard のテーブル名を返す"""
+    if not database:
+        yield 'main.timecard'
+        return
+    conn.execute("ATTACH DATABASE ? AS photo_archive", (database,))
+    try:
+        if create_index:
+            # 既存のアーカイブDBには photo_path のインデックスがない
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS photo_archive.idx_timecard_photo_path ON timecard (photo_path) "
+                "WHERE photo_path IS NOT NULL"
+            )
+            conn.commit()
+        yield 'photo_archive.timecard'
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE photo_archive")
+
+def photo_file_missing(photo_path: str) -> bool:
+    """photo_path の指すファイルが存在しないか（処理待ち・判別できない値は False）"""
+    if is_pending_photo(photo_path):
+        return False
+    path = resolve_photo_file(photo_key(photo_path))
+    return path is not None and not os.path.isfile(path)
+
+def recompress_photo(path: str, quality: int = PHOTO_RECOMPRESS_QUALITY,
+                     dry_run: bool = False) -> Optional[Tuple[str, int]]:
+    """
+    JPEG写真を指定画質で再圧縮し、(新しいファイル名, 削減したバイト数) を返す
+
+    写真は内容のハッシュ名で immutable に配信しているため、元のファイルは書き換えず、
+    再圧縮後の内容のハッシュ名で同じディレクトリに保存する（参照の付け替えと元の
+    ファイルの削除は呼び出し側で行う）。小さくならなければ何もせず None を返す。
+    """
+    stat = os.stat(path)
+    buffer = io.BytesIO()
+    with Image.open(path) as img:
+        if img.format != 'JPEG':
+            return None
+        img.save(buffer, 'JPEG', quality=quality, optimize=True)
+    saved = stat.st_size - buffer.tell()
+    if saved <= 0:
+        return None
+    name = hashlib.sha256(buffer.getbuffer()).hexdigest()[:PHOTO_HASH_LENGTH] + os.path.splitext(path)[1]
+    if not dry_run:
+        new_path = os.path.join(os.path.dirname(path), name)
+        temp_path = f"{new_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+        # 撮影時刻の目安として更新日時は元のファイルに合わせる
+        os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(temp_path, new_path)
+    return name, saved
+
+def replace_photo_references(conn: sqlite3.Connection, renames: List[Tuple[str, str]]) -> None:
+    """photo_path を (新しいパス, 元のパス) の組で付け替える（ホットDBの全テーブルと全アーカイブDB）"""
+    for database in photo_databases():
+        with attached_timecard(conn, database, create_index=True) as table:
+            tables = [table] if database else [f'main.{name}' for name in photo_reference_tables(conn)]
+            conn.execute("BEGIN IMMEDIATE")
+            for target in tables:
+                conn.executemany(f"UPDATE {target} SET photo_path = ? WHERE photo_path = ?", renames)
+            conn.commit()
 
-        # フルパス
-        full_photo_path = os.path.join(photo_dir, photo_filename)
+def iter_photo_days(photo_folder: str) -> Iterator[str]:
+    """写真の日付別ディレクトリ（'YYYY/MM/DD'）を古い順に列挙"""
+    def subdirectories(path: str, width: int) -> List[str]:
+        if not os.path.isdir(path):
+            return []
+        return sorted(name for name in os.listdir(path)
+                      if len(name) == width and name.isdigit() and os.path.isdir(os.path.join(path, name)))
+
+    for year in subdirectories(photo_folder, 4):
+        for month in subdirectories(os.path.join(photo_folder, year), 2):
+            for day in subdirectories(os.path.join(photo_folder, year, month), 2):
+                yield f"{year}/{month}/{day}"
+
+def photo_reference_tables(conn: sqlite3.Connection) -> List[str]:
+    """ホットDBで photo_path 列を持つテーブル（timecard のほか、顔データ登録時の写真など）"""
+    tables = [row['name'] for row in conn.execute(
+        "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    ).fetchall()]
+    return [table for table in tables if 'photo_path' in get_table_columns(conn, table)]
+
+def referenced_photo_names(conn: sqlite3.Connection, table: str, day: str) -> Set[str]:
+    """指定日のディレクトリ内で、table の photo_path（処理待ちを含む）から参照されているファイル名"""
+    names: Set[str] = set()
+    prefix = f"{PHOTO_PATH_PREFIX}{day}/"
+    for start in (prefix, PHOTO_PENDING_PREFIX + prefix):
+        # '/' の次の文字 '0' を上限にした範囲検索で photo_path のインデックスを使う
+        for row in conn.execute(
+            f"SELECT photo_path FROM {table} WHERE photo_path >= ? AND photo_path < ?",
+            (start, start[:-1] + '0')
+        ):
+            names.add(row['photo_path'][len(start):])
+    return names
+
+def maintain_photos(conn: sqlite3.Connection, dry_run: bool = False,
+                    retention_days: int = PHOTO_RETENTION_DAYS,
+                    recompress_after_days: int = PHOTO_RECOMPRESS_AFTER_DAYS,
+                    batch_size: int = PHOTO_MAINTENANCE_BATCH_SIZE,
+                    max_days: Optional[int] = None) -> Dict[str, int]:
+    """
+    打刻写真のメンテナンス（保存期間・再圧縮・DBとディスクの突き合わせ）
+
+    1. 勤務日が保存期間を過ぎた打刻記録の photo_path を外す
+    2. ファイルが存在しない photo_path を外す（id 順に batch_size 件ずつ）
+    3. 日付別ディレクトリを古い順に1日ずつ処理し、どの記録からも参照されない写真と
+       縮小版を削除、撮影から recompress_after_days 日を過ぎた写真を再圧縮する
+       （再圧縮した写真は新しいハッシュ名で保存して参照を付け替える。参照の確認には photo_path 列を持つホットDBの全テーブルを使う）
+    ホットDBと月別アーカイブDBの両方が対象。2. と 3. の進捗は maintenance_state に保存し、
+    中断しても再実行で続きから処理する。max_days を指定すると 3. をその日数で打ち切る。
+    """
+    result = dict.fromkeys(
+        ('expired_rows', 'missing_rows', 'orphan_files', 'variant_files', 'recompressed_files',
+         'days', 'bytes_reclaimed'), 0
+    )
+    if conn.in_transaction:
+        conn.commit()
+    databases = photo_databases()
+    today = datetime.now(JST).date()
+
+    # 1. 保存期間を過ぎた打刻の写真参照を外す（ファイルは 3. で孤立ファイルとして削除）
+    if retention_days > 0:
+        cutoff = int((today - timedelta(days=retention_days)).strftime('%Y%m%d'))
+        for database in databases:
+            with attached_timecard(conn, database, create_index=not dry_run) as table:
+                if dry_run:
+                    result['expired_rows'] += conn.execute(
+                        f"SELECT COUNT(*) FROM {table} WHERE work_date < ? AND photo_path IS NOT NULL", (cutoff,)
+                    ).fetchone()[0]
+                    continue
+                while True:
+                    conn.execute("BEGIN IMMEDIATE")
+                    expired = conn.execute(
+                        f"UPDATE {table} SET photo_path = NULL WHERE id IN "
+                        f"(SELECT id FROM {table} WHERE work_date < ? AND photo_path IS NOT NULL LIMIT ?)",
+                        (cutoff, batch_size)
+                    ).rowcount
+                    conn.commit()
+                    result['expired_rows'] += expired
+                    if expired < batch_size:
+                        break
+
+    # 2. ファイルが存在しない写真の参照を外す
+    for database in databases:
+        state_name = f"photo_rows:{os.path.basename(database) if database else 'main'}"
+        last_id = int(get_maintenance_state(conn, state_name) or 0)
+        with attached_timecard(conn, database, create_index=not dry_run) as table:
+            while True:
+                rows = conn.execute(
+                    f"SELECT id, photo_path FROM {table} WHERE id > ? AND photo_path IS NOT NULL ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                missing = [(row['id'], row['photo_path']) for row in rows if photo_file_missing(row['photo_path'])]
+                result['missing_rows'] += len(missing)
+                if dry_run:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(f"UPDATE {table} SET photo_path = NULL WHERE id = ? AND photo_path = ?", missing)
+                set_maintenance_state(conn, state_name, str(last_id))
+                conn.commit()
+        if not dry_run:
+            set_maintenance_state(conn, state_name, None)
+            conn.commit()
 
-        # 画像をJPEG形式で保存
-        if img.mode in ('RGBA', 'LA', 'P'):
-            # 透明度がある画像の場合は白背景で合成
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            mask = img.split()[-1] if img.mode == 'RGBA' else None
-            background.paste(img, mask=mask)
-            img = background
+    # 3. 日付別ディレクトリごとにディスク側を突き合わせる
+    photo_folder = app.config['PHOTO_FOLDER']
+    last_day = get_maintenance_state(conn, 'photo_files') or ''
+    recompressed_through = get_maintenance_state(conn, 'photo_recompressed') or ''
+    recompress_before = ((today - timedelta(days=recompress_after_days)).strftime('%Y/%m/%d')
+                         if recompress_after_days > 0 else '')
+    grace_cutoff = time.time() - PHOTO_ORPHAN_GRACE_SECONDS
+
+    for day in iter_photo_days(photo_folder):
+        if day <= last_day:
+            continue
+        if max_days is not None and result['days'] >= max_days:
+            break
+        directory = os.path.join(photo_folder, *day.split('/'))
+        files = {
+            entry.name: entry.stat() for entry in os.scandir(directory) if entry.is_file()
+        }
+
+        # 撮影日の月のDBで参照を確認し、削除候補は念のため他のアーカイブDBでも確認する
+        month = int(day[:7].replace('/', ''))
+        month_databases = [None] + ([archive_path(month)] if os.path.exists(archive_path(month)) else [])
+        referenced: Set[str] = set()
+        for database in month_databases:
+            with attached_timecard(conn, database) as table:
+                referenced |= referenced_photo_names(conn, table, day)
+        # 打刻記録以外から参照される写真（顔データ登録時の写真など）も削除しない
+        for table in photo_reference_tables(conn):
+            if table != 'timecard':
+                referenced |= referenced_photo_names(conn, f'main.{table}', day)
+        orphans = [name for name, stat in files.items()
+                   if name not in referenced and stat.st_mtime < grace_cutoff]
+        if orphans:
+            for database in databases:
+                if database not in month_databases:
+                    with attached_timecard(conn, database, create_index=not dry_run) as table:
+                        referenced |= referenced_photo_names(conn, table, day)
+            orphans = [name for name in orphans if name not in referenced]
+
+        # 参照されない写真（書き込み途中で残った一時ファイルを含む）を削除
+        for name in orphans:
+            result['orphan_files'] += 1
+            result['bytes_reclaimed'] += files.pop(name).st_size
+            if not dry_run:
+                os.remove(os.path.join(directory, name))
+
+        # 元の写真がなくなった縮小版を削除
+        for size in PHOTO_VARIANT_SIZES:
+            variant_directory = os.path.join(photo_folder, 'variants', size, *day.split('/'))
+            if not os.path.isdir(variant_directory):
+                continue
+            for entry in os.scandir(variant_directory):
+                if entry.is_file() and entry.name not in files:
+                    result['variant_files'] += 1
+                    result['bytes_reclaimed'] += entry.stat().st_size
+                    if not dry_run:
+                        os.remove(entry.path)
+
+        # 撮影から一定期間を過ぎた写真を再圧縮（一度処理した日は再圧縮しない）
+        # 再圧縮した写真は新しいハッシュ名で保存し、参照を付け替えてから元の写真と縮小版を削除する
+        recompress = recompressed_through < day < recompress_before
+        if recompress:
+            renames: List[Tuple[str, str]] = []
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() not in PHOTO_EXTENSIONS or name not in referenced:
+                    continue
+                try:
+                    recompressed = recompress_photo(os.path.join(directory, name), dry_run=dry_run)
+                except Exception as e:
+                    logger.warning(f"写真の再圧縮に失敗: {day}/{name} {e}")
+                    continue
+                if recompressed:
+                    new_name, saved = recompressed
+                    result['recompressed_files'] += 1
+                    result['bytes_reclaimed'] += saved
+                    renames.append((f"{PHOTO_PATH_PREFIX}{day}/{new_name}", f"{PHOTO_PATH_PREFIX}{day}/{name}"))
+            if renames and not dry_run:
+                replace_photo_references(conn, renames)
+                for _, old_path in renames:
+                    key = photo_key(old_path)
+                    for path in [os.path.join(photo_folder, *key.split('/'))] + [
+                            photo_variant_path(key, size) for size in PHOTO_VARIANT_SIZES]:
+                        if os.path.exists(path):
+                            os.remove(path)
+
+        result['days'] += 1
+        if dry_run:
+            continue
+        # 空になったディレクトリを削除
+        for path in (directory, os.path.dirname(directory), os.path.dirname(os.path.dirname(directory))):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+        set_maintenance_state(conn, 'photo_files', day)
+        if recompress:
+            set_maintenance_state(conn, 'photo_recompressed', day)
+        conn.commit()
+        logger.info(f"写真のメンテナンス中: {day}")
+    else:
+        # 最後まで処理したら、次回は最初の日から突き合わせる
+        if not dry_run:
+            set_maintenance_state(conn, 'photo_files', None)
+            conn.commit()
 
-        img.save(full_photo_path, 'JPEG', quality=85)
+    return result
 
-        # 修正: データベース用の相対パスを統一
-        relative_path = f"static/photos/{photo_filename}"
+def save_photo(photo: Optional[SpooledPhoto]) -> Optional[str]:
+    """写真保存機能（強化版）"""
+    if not photo:
+        return None
+    source, digest = photo
+    try:
+        relative_path = photo_relative_path(digest, datetime.now(JST))
+        write_photo(source, relative_path)
 
         logger.info(f"写真保存完了: {relative_path}")
         return relative_path
@@ -474,6 +2537,140 @@ def save_photo(photo_data: str, employee_id: str) -> Optional[str]:
     except Exception as e:
         logger.error(f"写真保存エラー: {e}")
         return None
+    finally:
+        source.close()
+
+# === 写真処理ワーカー ===
+
+def pending_photo_path(relative_path: str) -> str:
+    """処理待ちの写真を表す photo_path 値"""
+    return PHOTO_PENDING_PREFIX + relative_path
+
+def is_pending_photo(photo_path: Optional[str]) -> bool:
+    return bool(photo_path) and photo_path.startswith(PHOTO_PENDING_PREFIX)
+
+class PhotoProcessor:
+    """打刻写真の変換・保存をリクエスト外で行うワーカープール
+
+    打刻は処理待ちの photo_path（'pending:' 付き）で先に登録し、ワーカーが
+    画像を保存した後に正式なパスへ更新する（失敗時は NULL）。キューは上限付きで、
+    満杯のときは投入したリクエストのスレッドで処理する（バックプレッシャー）。
+    """
+
+    def __init__(self, workers: int, max_queue: int) -> None:
+        self.workers = workers
+        self._queue: 'queue.Queue[Optional[Tuple[int, IO[bytes], str]]]' = queue.Queue(maxsize=max_queue)
+        self._start_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._stats_lock = threading.Lock()
+        self._stats = {'processed': 0, 'failed': 0, 'inline': 0}
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        """キュー長と処理件数（監視用）"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update({'queue_depth': self.depth(), 'queue_max': self._queue.maxsize, 'workers': self.workers})
+        return stats
+
+    def submit(self, punch_id: int, source: IO[bytes], relative_path: str) -> None:
+        """打刻IDに紐づく写真（受信済みの一時ファイル）の処理を投入"""
+        self._ensure_started()
+        job = (punch_id, source, relative_path)
+        try:
+            self._queue.put(job, timeout=PHOTO_SUBMIT_TIMEOUT)
+        except queue.Full:
+            logger.warning(f"写真処理キューが満杯のためリクエスト内で処理します（{self.depth()}件待ち）")
+            self._count('inline')
+            self._process(job)
+
+    def shutdown(self) -> None:
+        """投入済みの写真をすべて処理してからワーカーを停止"""
+        alive = [thread for thread in self._threads if thread.is_alive()]
+        for _ in alive:
+            self._queue.put(None)
+        for thread in alive:
+            thread.join(timeout=PHOTO_DRAIN_TIMEOUT)
+        if self.depth():
+            logger.warning(f"未処理の写真が残っています: {self.depth()}件")
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'photo-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._process(job)
+
+    def _process(self, job: Tuple[int, IO[bytes], str]) -> None:
+        punch_id, source, relative_path = job
+        final_path: Optional[str] = relative_path
+        try:
+            write_photo(source, relative_path)
+            logger.info(f"写真保存完了: {relative_path}")
+        except Exception as e:
+            logger.error(f"写真保存エラー: punch_id={punch_id}, {e}")
+            final_path = None
+        finally:
+            source.close()
+
+        try:
+            conn = get_db_connection()
+            try:
+                updated = conn.execute(
+                    "UPDATE timecard SET photo_path = ? WHERE id = ? AND photo_path = ?",
+                    (final_path, punch_id, pending_photo_path(relative_path))
+                ).rowcount
+                conn.commit()
+                # 処理中に打刻が削除された（同じ内容の写真を使う他の打刻がなければファイルも削除）
+                orphaned = not updated and final_path and not conn.execute(
+                    "SELECT 1 FROM timecard WHERE photo_path IN (?, ?) LIMIT 1",
+                    (final_path, pending_photo_path(final_path))
+                ).fetchone()
+            finally:
+                conn.close()
+            if orphaned:
+                discard_photo(final_path)
+        except Exception as e:
+            logger.error(f"写真パス更新エラー: punch_id={punch_id}, {e}")
+            final_path = None
+
+        self._count('processed' if final_path else 'failed')
+
+photo_processor = PhotoProcessor(PHOTO_WORKERS, PHOTO_QUEUE_MAX)
+atexit.register(photo_processor.shutdown)
+
+def prepare_punch_photo(photo: Optional[SpooledPhoto], timestamp: datetime) -> Tuple[Optional[IO[bytes]], Optional[str]]:
+    """受信した打刻写真の (一時ファイル, 保存先の相対パス) を返す（写真なしは None）"""
+    if not photo:
+        return None, None
+    return photo[0], photo_relative_path(photo[1], timestamp)
+
+def close_spooled_photo(photo: Optional[SpooledPhoto]) -> None:
+    """写真処理ワーカーへ渡さなかった受信写真の一時ファイルを閉じる"""
+    if photo:
+        photo[0].close()
+
+def clear_pending_photos(conn: sqlite3.Connection) -> None:
+    """前回の停止時に処理されなかった写真の参照を外す"""
+    cleared = conn.execute(
+        "UPDATE timecard SET photo_path = NULL WHERE photo_path LIKE ?", (PHOTO_PENDING_PREFIX + '%',)
+    ).rowcount
+    if cleared:
+        logger.warning(f"処理されなかった打刻写真の参照を削除しました: {cleared}件")
 
 # === ルーティングとAPI ===
 
@@ -733,10 +2930,7 @@ def internal_error(error: Any) -> Tuple[str, int]:
 
 @app.route('/api/employees', methods=['GET'])
 def get_employees():
-    conn = get_db_connection()
-    employees = conn.execute('SELECT * FROM employees').fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in employees])
+    return jsonify(employee_directory.list_all())
 
 @app.route('/api/employees', methods=['POST'])
 @login_required
@@ -758,7 +2952,7 @@ def add_employee():
         conn.execute("INSERT INTO employees (employee_id, name, factory, employment_type) VALUES (?, ?, ?, ?)",
                      (employee_id, name, factory, employment_type))
         conn.commit()
-        generate_qr_code(str(employee_id))
+        employee_directory.bump()
         return jsonify({'success': True, 'message': '従業員を追加しました'})
     except sqlite3.IntegrityError:
         return jsonify({'success': False, 'message': 'この従業員IDは既に使用されています'})
@@ -773,6 +2967,9 @@ def delete_employee(id: int):
     if employee:
         conn.execute('DELETE FROM employees WHERE id = ?', (id,))
         conn.commit()
+        employee_directory.bump()
+        face_index.bump()
+        # 以前のバージョンで保存したQRコード画像が残っていれば削除
         qr_path = os.path.join(app.root_path, app.config['QR_FOLDER'], f'{employee["employee_id"]}.png')
         if os.path.exists(qr_path):
             os.remove(qr_path)
@@ -788,83 +2985,294 @@ def regenerate_qr(id: int):
     employee = conn.execute('SELECT * FROM employees WHERE id = ?', (id,)).fetchone()
     conn.close()
     if employee:
-        generate_qr_code(str(employee['employee_id']))
+        # QRコードは表示時に従業員IDから生成するため、保存済みの古い画像を削除するだけでよい
+        qr_path = os.path.join(app.root_path, app.config['QR_FOLDER'], f'{employee["employee_id"]}.png')
+        if os.path.exists(qr_path):
+            os.remove(qr_path)
         return jsonify({'success': True, 'message': 'QRコードを再生成しました'})
     return jsonify({'success': False, 'message': '従業員が見つかりません'})
 
-@app.route('/api/employees/generate-all-qr', methods=['POST'])
-@login_required
-def generate_all_qr():
-    conn = get_db_connection()
-    employees = conn.execute('SELECT employee_id FROM employees').fetchall()
-    conn.close()
-    for emp in employees:
-        generate_qr_code(str(emp['employee_id']))
-    return jsonify({'success': True, 'message': 'すべてのQRコードを生成しました'})
+# === 打刻端末（キオスク）の登録・認証 ===
+# 打刻時刻を端末が決める一括打刻APIなどは、管理者が発行した端末トークンを
+# X-Kiosk-Token ヘッダーで送った端末からのみ受け付ける。DBにはトークンのSHA-256だけを保存する。
+
+KIOSK_TOKEN_HEADER = 'X-Kiosk-Token'
+
+def hash_kiosk_token(token: str) -> str:
+    """端末トークンの保存・照合用ハッシュ"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def issue_kiosk_device(conn: sqlite3.Connection, name: str) -> Tuple[str, str]:
+    """打刻端末を登録し、(device_id, トークン) を返す（トークンはこの時だけ取得できる。コミットは呼び出し側）"""
+    device_id = f"kiosk-{secrets.token_hex(4)}"
+    token = secrets.token_urlsafe(32)
+    conn.execute(
+        "INSERT INTO kiosk_devices (device_id, name, token_hash, created_at) VALUES (?, ?, ?, ?)",
+        (device_id, name, hash_kiosk_token(token), datetime.now(JST).isoformat())
+    )
+    return device_id, token
+
+def authenticate_kiosk_device(token: Optional[str]) -> Optional[str]:
+    """端末トークンを照合し、有効な登録済み端末の device_id を返す（無効なら None）"""
+    if not token:
+        return None
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT device_id FROM kiosk_devices WHERE token_hash = ? AND revoked_at IS NULL",
+            (hash_kiosk_token(token),)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row['device_id'] if row else None
+
+def kiosk_required(view: Callable[..., Any]) -> Callable[..., Any]:
+    """登録済みの打刻端末からのリクエストのみ受け付ける（device_id は g.kiosk_device_id）"""
+    @wraps(view)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        device_id = authenticate_kiosk_device(request.headers.get(KIOSK_TOKEN_HEADER))
+        if not device_id:
+            logger.warning(f"未登録の端末からのリクエストを拒否しました: {request.path} ({request.remote_addr})")
+            return jsonify({
+                'success': False,
+                'message': 'この端末は登録されていません。管理者に端末の登録を依頼してください'
+            }), 401
+        g.kiosk_device_id = device_id
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/kiosk-devices', methods=['GET'])
+@login_required
+def list_kiosk_devices():
+    conn = get_db_connection()
+    rows = conn.execute(
+        "SELECT device_id, name, created_at, revoked_at FROM kiosk_devices ORDER BY id"
+    ).fetchall()
+    conn.close()
+    return jsonify([dict(row) for row in rows])
+
+@app.route('/api/kiosk-devices', methods=['POST'])
+@login_required
+def add_kiosk_device():
+    """打刻端末を登録してトークンを発行（トークンと設定用URLはこの応答でのみ返す）"""
+    data = request.get_json(silent=True) or {}
+    name = str(data.get('name') or '').strip()
+    if not name:
+        return jsonify({'success': False, 'message': '端末名を入力してください'}), 400
+
+    conn = get_db_connection()
+    try:
+        device_id, token = issue_kiosk_device(conn, name)
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"打刻端末を登録しました: {device_id} ({name})")
+    return jsonify({
+        'success': True,
+        'message': '端末を登録しました',
+        'device_id': device_id,
+        'token': token,
+        # フラグメントはサーバーへ送られないため、トークンがアクセスログに残らない
+        'setup_url': f"{request.host_url.rstrip('/')}{url_for('mobile')}#kiosk_token={token}"
+    })
+
+@app.route('/api/kiosk-devices/<device_id>', methods=['DELETE'])
+@login_required
+def revoke_kiosk_device(device_id: str):
+    conn = get_db_connection()
+    try:
+        result = conn.execute(
+            "UPDATE kiosk_devices SET revoked_at = ? WHERE device_id = ? AND revoked_at IS NULL",
+            (datetime.now(JST).isoformat(), device_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    if result.rowcount == 0:
+        return jsonify({'success': False, 'message': '端末が見つかりません'}), 404
+    logger.info(f"打刻端末の登録を解除しました: {device_id}")
+    return jsonify({'success': True, 'message': '端末の登録を解除しました'})
+
+# === 顔認証関連API ===
+# 顔特徴量は face_data.face_descriptor に float32（リトルエンディアン）のBLOBで保存する。
+# 本人判定（距離の計算）はサーバー側で行い、ブラウザの判定結果は信用しない。
+
+def encode_face_descriptor(values: Any) -> bytes:
+    """顔特徴量（数値のリスト）を保存用のBLOBに変換（不正な値は ValueError）"""
+    try:
+        descriptor = np.asarray(values, dtype='<f4')
+    except (TypeError, ValueError):
+        raise ValueError('顔データの形式が正しくありません')
+    if descriptor.shape != (FACE_DESCRIPTOR_LENGTH,) or not np.isfinite(descriptor).all():
+        raise ValueError('顔データの形式が正しくありません')
+    return descriptor.tobytes()
+
+def decode_face_descriptor(blob: bytes) -> np.ndarray:
+    """保存されたBLOBを顔特徴量の配列に変換"""
+    return np.frombuffer(blob, dtype='<f4')
+
+def match_face_descriptor(conn: sqlite3.Connection, employee_id: str, values: Any) -> Optional[Tuple[bool, float]]:
+    """
+    顔特徴量を登録済みデータと照合し、(本人か, 距離) を返す
+
+    顔データが未登録の場合は None、顔特徴量が不正な場合は ValueError。
+    """
+    probe = decode_face_descriptor(encode_face_descriptor(values))
+    row = conn.execute('SELECT face_descriptor FROM face_data WHERE employee_id = ?', (employee_id,)).fetchone()
+    if not row:
+        return None
+    distance = float(np.linalg.norm(decode_face_descriptor(row['face_descriptor']) - probe))
+    return distance <= FACE_DISTANCE_THRESHOLD, distance
+
+class FaceIndex:
+    """全従業員の顔特徴量の行列（1:N 照合用、スレッドセーフ）
 
-# === 顔認証関連API ===
+    初回照合時に face_data を (人数 x 128) の float32 行列として一括で読み込む
+    （削除済みの従業員の顔データは含めない）。顔データの登録・従業員の削除時に
+    bump() でバージョンを進め、次回照合時に再読み込みする。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._version = 0
+        self._loaded_version = -1
+        self._employee_ids: List[str] = []
+        self._matrix = np.empty((0, FACE_DESCRIPTOR_LENGTH), dtype=np.float32)
+        self._squared_norms = np.empty(0, dtype=np.float32)
+
+    def bump(self) -> None:
+        """顔データの変更を通知（次回照合時に再読み込み）"""
+        with self._lock:
+            self._version += 1
+
+    def _snapshot(self) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        with self._lock:
+            if self._loaded_version == self._version:
+                return self._employee_ids, self._matrix, self._squared_norms
+            version = self._version
+
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('''
+                SELECT f.employee_id, f.face_descriptor FROM face_data AS f
+                JOIN employees AS e ON e.employee_id = f.employee_id
+                ORDER BY f.id
+            ''').fetchall()
+        finally:
+            conn.close()
+
+        employee_ids = [row['employee_id'] for row in rows]
+        matrix = np.frombuffer(b''.join(row['face_descriptor'] for row in rows), dtype='<f4')
+        matrix = matrix.reshape(len(rows), FACE_DESCRIPTOR_LENGTH).astype(np.float32)
+        squared_norms = np.einsum('ij,ij->i', matrix, matrix)
+        with self._lock:
+            # 読み込み中に bump() された場合は読み込んだ内容を採用しない
+            if self._version == version:
+                self._employee_ids, self._matrix, self._squared_norms = employee_ids, matrix, squared_norms
+                self._loaded_version = version
+        logger.info(f"顔データを読み込みました: {len(employee_ids)}件（version={version}）")
+        return employee_ids, matrix, squared_norms
+
+    def identify(self, values: Any, k: int) -> List[Tuple[str, float]]:
+        """顔特徴量に近い順に最大 k 人の (従業員ID, 距離) を返す（不正な顔特徴量は ValueError）"""
+        probe = decode_face_descriptor(encode_face_descriptor(values))
+        employee_ids, matrix, squared_norms = self._snapshot()
+        if not employee_ids:
+            return []
+        # |a - b|^2 = |a|^2 - 2a・b + |b|^2 を行列とベクトルの積1回で計算
+        squared = squared_norms - 2 * (matrix @ probe) + probe @ probe
+        k = min(k, len(employee_ids))
+        nearest = np.argpartition(squared, k - 1)[:k]
+        nearest = nearest[np.argsort(squared[nearest])]
+        distances = np.sqrt(np.maximum(squared[nearest], 0))
+        return [(employee_ids[i], float(distance)) for i, distance in zip(nearest, distances)]
+
+face_index = FaceIndex()
+
+def face_verification_result(verified: bool, distance: float) -> Dict[str, Any]:
+    """照合結果のレスポンス項目（類似度は face-api.js の画面表示と同じ 1 - 距離）"""
+    return {
+        'verified': verified,
+        'distance': round(distance, 4),
+        'similarity': round(max(0.0, 1.0 - distance), 4),
+        'threshold': FACE_DISTANCE_THRESHOLD
+    }
 
 @app.route('/api/face/register', methods=['POST'])
 @login_required
 def register_face_data():
     """顔データ登録API（写真保存対応・修正版）"""
+    photo: Optional[SpooledPhoto] = None
     try:
-        data = request.json
+        # JSON / multipart / 画像本文に対応（写真は一時ファイルで受け取る）
+        data, photo, _ = read_photo_request()
+        if not data:
+            return jsonify({'success': False, 'message': '無効なリクエストデータです'})
         employee_id = data.get('employee_id')
         face_descriptor = data.get('face_descriptor')
-        photo_data = data.get('photo')  # 写真データを追加で受け取る
         
         if not employee_id or not face_descriptor:
             return jsonify({'success': False, 'message': '従業員IDと顔データは必須です'})
         
         # 従業員存在確認
-        conn = get_db_connection()
-        employee = conn.execute('SELECT * FROM employees WHERE employee_id = ?', (employee_id,)).fetchone()
+        employee = employee_directory.get(employee_id)
         
         if not employee:
-            conn.close()
             return jsonify({'success': False, 'message': '従業員が見つかりません'})
         
+        try:
+            descriptor_blob = encode_face_descriptor(face_descriptor)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)})
+        
+        conn = get_db_connection()
+        
         # 写真保存（顔認証登録時）
-        photo_path = None
-        if photo_data:
-            photo_path = save_photo(photo_data, employee_id)
-            if photo_path:
-                logger.info(f"顔認証登録時の写真を保存: {photo_path}")
-        
-        # 顔データを文字列として保存
-        descriptor_str = ','.join(map(str, face_descriptor))
+        photo_path = save_photo(photo)
+        if photo_path:
+            logger.info(f"顔認証登録時の写真を保存: {photo_path}")
+        
         now = datetime.now(JST).isoformat()
         
         # 既存データの更新または新規登録
         existing = conn.execute('SELECT id FROM face_data WHERE employee_id = ?', (employee_id,)).fetchone()
         
+        # 写真は photo_path で参照する（参照のない写真は写真のメンテナンスで削除される）
         if existing:
             conn.execute('''
                 UPDATE face_data 
-                SET face_descriptor = ?, updated_at = ?
+                SET face_descriptor = ?, photo_path = COALESCE(?, photo_path), updated_at = ?
                 WHERE employee_id = ?
-            ''', (descriptor_str, now, employee_id))
+            ''', (descriptor_blob, photo_path, now, employee_id))
             message = f'{employee["name"]}さんの顔データを更新しました'
         else:
             conn.execute('''
-                INSERT INTO face_data (employee_id, face_descriptor, created_at, updated_at)
-                VALUES (?, ?, ?, ?)
-            ''', (employee_id, descriptor_str, now, now))
+                INSERT INTO face_data (employee_id, face_descriptor, photo_path, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (employee_id, descriptor_blob, photo_path, now, now))
             message = f'{employee["name"]}さんの顔データを登録しました'
         
         conn.commit()
         conn.close()
+        employee_directory.bump()
+        face_index.bump()
         
         return jsonify({'success': True, 'message': message})
         
     except Exception as e:
         logger.error(f"顔データ登録エラー: {e}")
         return jsonify({'success': False, 'message': f'顔データ登録中にエラーが発生しました: {e}'})
+    finally:
+        close_spooled_photo(photo)
 
 @app.route('/api/face/verify', methods=['POST'])
 def verify_face_data():
-    """顔認証検証API"""
+    """
+    顔認証検証API
+
+    face_descriptor を登録済みの顔データと照合し、距離と判定結果を返す。
+    face_descriptor が空の場合は顔データの登録有無のみを返す。
+    """
     try:
         data = request.json
         employee_id = data.get('employee_id')
@@ -874,15 +3282,18 @@ def verify_face_data():
             return jsonify({'success': False, 'message': '従業員IDは必須です'})
         
         conn = get_db_connection()
+        try:
+            if not face_descriptor:
+                registered = conn.execute(
+                    'SELECT 1 FROM face_data WHERE employee_id = ?', (employee_id,)
+                ).fetchone() is not None
+                match = (False, 0.0) if registered else None
+            else:
+                match = match_face_descriptor(conn, employee_id, face_descriptor)
+        finally:
+            conn.close()
         
-        # 登録済み顔データを取得
-        face_data = conn.execute('''
-            SELECT face_descriptor FROM face_data WHERE employee_id = ?
-        ''', (employee_id,)).fetchone()
-        
-        conn.close()
-        
-        if not face_data:
+        if match is None:
             return jsonify({
                 'success': False, 
                 'message': '顔データが未登録です',
@@ -891,48 +3302,64 @@ def verify_face_data():
         
         # 空の face_descriptor の場合は登録データの存在確認のみ
         if not face_descriptor:
-            stored_descriptor = [float(x) for x in face_data['face_descriptor'].split(',')]
-            return jsonify({
-                'success': True,
-                'stored_descriptor': stored_descriptor
-            })
+            return jsonify({'success': True, 'registered': True, 'threshold': FACE_DISTANCE_THRESHOLD})
         
-        # 顔認証実行（実際の実装では face-api.js の距離計算を使用）
-        stored_descriptor = [float(x) for x in face_data['face_descriptor'].split(',')]
-        
-        return jsonify({
-            'success': True,
-            'stored_descriptor': stored_descriptor,
-            'similarity': 0.85  # プレースホルダー値
-        })
+        return jsonify({'success': True, **face_verification_result(*match)})
         
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         logger.error(f"顔認証検証エラー: {e}")
         return jsonify({'success': False, 'message': f'顔認証検証中にエラーが発生しました: {e}'})
 
+@app.route('/api/face/identify', methods=['POST'])
+@kiosk_required
+def identify_face():
+    """
+    顔認証による従業員の特定API（1:N 照合、登録済みの打刻端末のみ）
+
+    face_descriptor に近い順に最大 k 人（既定 FACE_IDENTIFY_DEFAULT_K）の従業員と距離を返す。
+    従業員名簿が漏れないよう、返すのはしきい値（FACE_DISTANCE_THRESHOLD）以内の候補だけ。
+    """
+    try:
+        data = request.json
+        if not data:
+            return jsonify({'success': False, 'message': '無効なリクエストデータです'})
+        try:
+            k = int(data.get('k', FACE_IDENTIFY_DEFAULT_K))
+        except (TypeError, ValueError):
+            k = 0
+        if not 1 <= k <= FACE_IDENTIFY_MAX_K:
+            return jsonify({'success': False, 'message': f'k は 1〜{FACE_IDENTIFY_MAX_K} で指定してください'})
+        
+        matches = []
+        for employee_id, distance in face_index.identify(data.get('face_descriptor'), k):
+            if distance > FACE_DISTANCE_THRESHOLD:
+                break  # 近い順のため以降もしきい値外
+            employee = employee_directory.get(employee_id)
+            if not employee:
+                continue
+            matches.append({
+                'employee_id': employee_id,
+                'name': employee['name'],
+                **face_verification_result(True, distance)
+            })
+        
+        return jsonify({'success': True, 'matches': matches, 'threshold': FACE_DISTANCE_THRESHOLD})
+        
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    except Exception as e:
+        logger.error(f"顔認証特定エラー: {e}")
+        return jsonify({'success': False, 'message': f'顔認証中にエラーが発生しました: {e}'})
+
 @app.route('/api/face/status')
 @login_required
 def get_face_data_status():
     """全従業員の顔データ登録状況取得API"""
     try:
-        conn = get_db_connection()
-        
-        # 全従業員と顔データの登録状況を取得
-        result = conn.execute('''
-            SELECT e.employee_id, 
-                   CASE WHEN f.employee_id IS NOT NULL THEN 1 ELSE 0 END as has_face_data
-            FROM employees e
-            LEFT JOIN face_data f ON e.employee_id = f.employee_id
-        ''').fetchall()
-        
-        conn.close()
-        
-        # 辞書形式で返す
-        status = {}
-        for row in result:
-            status[row['employee_id']] = bool(row['has_face_data'])
-        
-        return jsonify(status)
+        # 全従業員と顔データの登録状況を辞書形式で返す（従業員名簿キャッシュから取得）
+        return jsonify(employee_directory.face_data_status())
         
     except Exception as e:
         logger.error(f"顔データ状況取得エラー: {e}")
@@ -955,16 +3382,13 @@ def check_consistency():
         if not employee_id or not action:
             return jsonify({'success': False, 'message': '従業員IDとアクションは必須です', 'play_error_sound': True})
 
-        conn = get_db_connection()
-        employee = conn.execute('SELECT * FROM employees WHERE employee_id = ?', (employee_id,)).fetchone()
+        employee = employee_directory.get(employee_id)
         
         if not employee:
-            conn.close()
             return jsonify({'success': False, 'message': f'従業員ID {employee_id} が見つかりません', 'play_error_sound': True})
         
         # 整合性チェック実行
         is_valid, error_message = punch_validator.validate_punch(employee_id, action, custom_date)
-        conn.close()
         
         if is_valid:
             return jsonify({
@@ -991,10 +3415,13 @@ def check_consistency():
 
 @app.route('/api/timecard/manual', methods=['POST'])
 @login_required
+@idempotent
 def manual_punch():
     """手動打刻API（修正版：自動写真撮影・保存機能追加）"""
+    photo: Optional[SpooledPhoto] = None
     try:
-        data = request.json
+        # JSON / multipart / 画像本文に対応（写真は一時ファイルで受け取る）
+        data, photo, photo_sent = read_photo_request()
         if not data:
             return jsonify({'success': False, 'message': '無効なリクエストデータです'})
 
@@ -1002,7 +3429,6 @@ def manual_punch():
         action = data.get('action')
         custom_date = data.get('date')
         custom_time = data.get('time')
-        photo_data = data.get('photo')  # 追加：写真データを受け取る
         
         if not employee_id or not action:
             return jsonify({'success': False, 'message': '従業員IDとアクションは必須です'})
@@ -1025,10 +3451,8 @@ def manual_punch():
 
         logger.info(f"手動打刻: employee_id={employee_id}, action={action}, time={timestamp}")
 
-        conn = get_db_connection()
-        employee = conn.execute('SELECT * FROM employees WHERE employee_id = ?', (employee_id,)).fetchone()
+        employee = employee_directory.get(employee_id)
         if not employee:
-            conn.close()
             return jsonify({
                 'success': False, 
                 'message': f'従業員ID {employee_id} が見つかりません',
@@ -1038,45 +3462,45 @@ def manual_punch():
         # 指定された日付で整合性チェックを実行
         is_valid, error_message = punch_validator.validate_punch(employee_id, action, target_date)
         if not is_valid:
-            conn.close()
             return jsonify({
                 'success': False, 
                 'message': error_message,
                 'voice': error_message
             })
 
-        # 修正：写真保存処理の追加
-        photo_path = None
-        if photo_data:
-            photo_path = save_photo(photo_data, employee_id)
-            if photo_path:
-                logger.info(f"手動打刻時写真保存成功: {photo_path}")
-            else:
-                logger.warning("手動打刻時写真保存に失敗")
+        # 写真は受信済みの一時ファイルのまま、変換・保存は打刻登録後にワーカーで処理する
+        photo_source, photo_path = prepare_punch_photo(photo, timestamp)
 
+        conn = get_db_connection()
         try:
             # データベースに保存する際のタイムスタンプ形式（修正版）
             timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
             
-            conn.execute("""
-                INSERT INTO timecard (employee_id, timestamp, action, photo_path, location)
-                VALUES (?, ?, ?, ?, ?)
-            """, (employee_id, timestamp_str, action, photo_path, '手動'))
+            punch_id = record_punch(conn, employee_id, action, timestamp, '手動',
+                                    pending_photo_path(photo_path) if photo_path else None)
 
             logger.info(f"打刻記録完了: {timestamp_str}, {action}")
             
-            conn.commit()
-            
+        except PunchRejected as e:
+            conn.close()
+            return jsonify({
+                'success': False, 
+                'message': str(e),
+                'voice': str(e)
+            })
         except Exception as e:
-            conn.rollback()
             conn.close()
             logger.error(f"手動打刻データベースエラー: {e}")
+            skip_idempotency_record()
             return jsonify({
                 'success': False, 
                 'message': f'データベースエラー: {e}'
             })
             
         conn.close()
+        if photo_source and photo_path:
+            photo_processor.submit(punch_id, photo_source, photo_path)
+            photo = None  # 一時ファイルはワーカーが閉じる
         
         action_names = {
             'in': '出勤',
@@ -1101,8 +3525,9 @@ def manual_punch():
         if photo_path:
             response_data['message'] += ' 📷'
             response_data['photo_saved'] = True
+            response_data['photo_pending'] = True
             response_data['photo_path'] = photo_path
-        elif photo_data:
+        elif photo_sent:
             response_data['message'] += ' (写真保存失敗)'
             response_data['photo_saved'] = False
         
@@ -1110,40 +3535,57 @@ def manual_punch():
         
     except Exception as e:
         logger.error(f"手動打刻全般エラー: {e}")
+        skip_idempotency_record()
         return jsonify({
             'success': False,
             'message': f'システムエラー: {e}'
         })
+    finally:
+        close_spooled_photo(photo)
 
 @app.route('/api/timecard', methods=['POST'])
+@idempotent
 def punch_timecard():
     """打刻処理 (モバイル用) - 強化された整合性チェックと顔認証時写真撮影対応（修正版）"""
+    photo: Optional[SpooledPhoto] = None
     try:
-        data = request.json
+        # JSON / multipart / 画像本文に対応（写真は一時ファイルで受け取る）
+        data, photo, photo_sent = read_photo_request()
         if not data:
             return jsonify({'success': False, 'message': '無効なリクエストデータです', 'voice': '無効なリクエストです'})
 
         employee_id = data.get('employee_id')
         action = data.get('action')
-        photo_data = data.get('photo')
-        face_verified = data.get('face_verified', False)
-        face_similarity = data.get('face_similarity', 0)
 
-        logger.info(f"打刻処理開始: employee_id={employee_id}, action={action}, face_verified={face_verified}")
-        
         if not employee_id or not action:
             return jsonify({'success': False, 'message': '従業員IDとアクションは必須です', 'voice': '必要な情報が不足しています'})
+
+        # 顔認証はクライアントの判定結果ではなく、送信された顔特徴量をサーバー側で照合して判定する
+        face_verified = False
+        face_similarity = 0.0
+        if data.get('face_descriptor'):
+            conn = get_db_connection()
+            try:
+                match = match_face_descriptor(conn, employee_id, data['face_descriptor'])
+            except ValueError:
+                match = None
+            finally:
+                conn.close()
+            if match:
+                face_verified = match[0]
+                face_similarity = face_verification_result(*match)['similarity']
+        elif data.get('face_verified'):
+            logger.warning(f"顔特徴量なしの顔認証済み打刻は認証なしとして扱います: {employee_id}")
+
+        logger.info(f"打刻処理開始: employee_id={employee_id}, action={action}, face_verified={face_verified}")
         
-        conn = get_db_connection()
-        employee = conn.execute('SELECT * FROM employees WHERE employee_id = ?', (employee_id,)).fetchone()
+        employee = employee_directory.get(employee_id)
         if not employee:
-            conn.close()
             return jsonify({'success': False, 'message': '従業員情報が見つかりません', 'voice': '従業員情報がありません', 'play_error_sound': True})
 
-        # 強化された打刻の整合性チェック
+        # 強化された打刻の整合性チェック（キャッシュによる事前チェック、確定判定は登録時に行う）
         is_valid, error_message = punch_validator.validate_punch(employee_id, action)
         if not is_valid:
-            conn.close()
             return jsonify({
                 'success': False, 
                 'message': error_message, 
@@ -1154,33 +3596,36 @@ def punch_timecard():
         # JST タイムゾーンで現在時刻を取得
         now = datetime.now(JST)
         
-        # 写真保存処理（修正版）
-        photo_path = None
-        if photo_data:
-            photo_path = save_photo(photo_data, employee_id)
-            if photo_path:
-                logger.info(f"打刻時写真保存成功: {photo_path}")
-            else:
-                logger.warning("打刻時写真保存に失敗")
+        # 写真は受信済みの一時ファイルのまま、変換・保存は打刻登録後にワーカーで処理する
+        photo_source, photo_path = prepare_punch_photo(photo, now)
 
+        conn = get_db_connection()
         try:
-            # データベースに保存
+            # 整合性チェックとデータベース保存を1トランザクションで実行
             timestamp_str = now.strftime('%Y-%m-%d %H:%M:%S')
-            conn.execute("""
-                INSERT INTO timecard (employee_id, timestamp, action, photo_path, location)
-                VALUES (?, ?, ?, ?, ?)
-            """, (employee_id, timestamp_str, action, photo_path, 'モバイル'))
+            punch_id = record_punch(conn, employee_id, action, now, 'モバイル',
+                                    pending_photo_path(photo_path) if photo_path else None)
 
             logger.info(f"打刻記録完了: {timestamp_str}, {action}")
-            conn.commit()
 
+        except PunchRejected as e:
+            conn.close()
+            return jsonify({
+                'success': False, 
+                'message': str(e), 
+                'voice': str(e),
+                'play_error_sound': True
+            })
         except Exception as e:
-            conn.rollback()
             conn.close()
             logger.error(f"データベース操作エラー: {e}")
+            skip_idempotency_record()
             return jsonify({'success': False, 'message': f'データベースエラー: {e}', 'voice': 'データベースエラーです', 'play_error_sound': True})
         
         conn.close()
+        if photo_source and photo_path:
+            photo_processor.submit(punch_id, photo_source, photo_path)
+            photo = None  # 一時ファイルはワーカーが閉じる
         
         voice_messages = {
             'in': f'{employee["name"]}さん、おはようございます。出勤を記録しました',
@@ -1201,11 +3646,12 @@ def punch_timecard():
         # 修正: 写真保存結果の報告を改善
         if photo_path:
             response_data['photo_saved'] = True
+            response_data['photo_pending'] = True
             response_data['photo_path'] = photo_path
-            logger.info(f"打刻時写真保存レスポンス: {photo_path}")
+            logger.info(f"打刻時写真保存レスポンス（処理待ち）: {photo_path}")
         else:
             response_data['photo_saved'] = False
-            if photo_data:
+            if photo_sent:
                 logger.warning("写真データはあったが保存に失敗")
             else:
                 logger.debug("写真データなし")
@@ -1219,12 +3665,127 @@ def punch_timecard():
         
     except Exception as e:
         logger.error(f"打刻処理全般エラー: {e}")
+        skip_idempotency_record()
         return jsonify({
             'success': False,
             'message': f'システムエラー: {e}',
             'voice': 'システムエラーが発生しました',
             'play_error_sound': True
         })
+    finally:
+        close_spooled_photo(photo)
+
+@app.route('/api/timecard/batch', methods=['POST'])
+@kiosk_required
+def punch_timecard_batch():
+    """
+    オフライン端末からの一括打刻API（登録済みの打刻端末のみ）
+
+    リクエスト: {"punches": [{"client_id", "employee_id", "action",
+    "timestamp", "photo"}, ...]}（打刻した順）。全件を1トランザクションで登録し、
+    打刻ごとの結果を results として同じ順序で返す。打刻時刻は端末が決めるため、
+    登録した行には端末トークンから求めた device_id を記録する。
+    """
+    punches: List[Dict[str, Any]] = []
+    try:
+        data = request.json
+        if not data or not isinstance(data.get('punches'), list):
+            return jsonify({'success': False, 'message': '無効なリクエストデータです'}), 400
+
+        items = data['punches']
+        if len(items) > BATCH_PUNCH_MAX_ITEMS:
+            return jsonify({
+                'success': False,
+                'message': f'一度に送信できる打刻は{BATCH_PUNCH_MAX_ITEMS}件までです'
+            }), 413
+
+        device_id = g.kiosk_device_id
+        logger.info(f"一括打刻受信: device_id={device_id}, 件数={len(items)}")
+
+        now = datetime.now(JST)
+        oldest = now - timedelta(days=BATCH_PUNCH_MAX_AGE_DAYS)
+        latest = now + timedelta(seconds=BATCH_PUNCH_MAX_FUTURE_SECONDS)
+
+        results: List[Dict[str, Any]] = []
+        for item in items:
+            if not isinstance(item, dict):
+                item = {}
+            result: Dict[str, Any] = {'client_id': item.get('client_id'), 'success': False}
+            results.append(result)
+
+            employee_id = item.get('employee_id')
+            action = item.get('action')
+            if not employee_id or action not in ACTION_CODES:
+                result['message'] = '従業員IDとアクションが不正です'
+                continue
+            employee = employee_directory.get(employee_id)
+            if not employee:
+                result['message'] = f'従業員ID {employee_id} が見つかりません'
+                continue
+            try:
+                timestamp = parse_timestamp(str(item.get('timestamp', '')))
+            except ValueError:
+                result['message'] = 'タイムスタンプの形式が不正です'
+                continue
+            if not oldest <= timestamp <= latest:
+                result['message'] = '受付期間外の打刻です'
+                continue
+
+            result['employee_name'] = employee['name']
+
+            # オンライン送信がタイムアウトしたが実際には届いていた打刻（client_id は送信時の Idempotency-Key）
+            if item.get('client_id'):
+                stored = idempotency_store.lookup(f"/api/timecard:{item['client_id']}")
+                if stored is not None and json.loads(stored[1]).get('success'):
+                    result.update({'success': True, 'duplicate': True})
+                    continue
+
+            try:
+                photo = spool_photo([decode_photo_data(item['photo'])]) if item.get('photo') else None
+            except ValueError as e:
+                logger.warning(f"一括打刻の写真データの読み込みに失敗: {e}")
+                photo = None
+            photo_source, photo_file = prepare_punch_photo(photo, timestamp)
+            punches.append({
+                'employee_id': employee_id,
+                'action': action,
+                'timestamp': timestamp,
+                'photo_path': pending_photo_path(photo_file) if photo_file else None,
+                'photo': (photo_source, photo_file),
+                'result': result
+            })
+
+        if punches:
+            conn = get_db_connection()
+            try:
+                outcomes = record_punch_batch(conn, punches, 'オフライン', device_id)
+            finally:
+                conn.close()
+
+            for punch, outcome in zip(punches, outcomes):
+                punch['result'].update(outcome)
+                photo_source, photo_file = punch['photo']
+                if outcome['success'] and not outcome.get('duplicate') and photo_source and photo_file:
+                    photo_processor.submit(outcome['id'], photo_source, photo_file)
+                    punch['photo'] = (None, None)  # 一時ファイルはワーカーが閉じる
+
+        accepted = sum(1 for result in results if result['success'])
+        logger.info(f"一括打刻完了: device_id={device_id}, 登録={accepted}, 拒否={len(results) - accepted}")
+        return jsonify({
+            'success': True,
+            'accepted': accepted,
+            'rejected': len(results) - accepted,
+            'results': results
+        })
+
+    except Exception as e:
+        logger.error(f"一括打刻エラー: {e}")
+        return jsonify({'success': False, 'message': f'システムエラー: {e}'}), 500
+    finally:
+        # 拒否・重複した打刻など、ワーカーへ渡さなかった写真の一時ファイルを閉じる
+        for punch in punches:
+            if punch['photo'][0]:
+                punch['photo'][0].close()
 
 # === 勤怠記録管理API ===
 
@@ -1244,17 +3805,14 @@ def update_timecard():
     if not all([punch_id, new_timestamp, new_action]):
         return jsonify({'success': False, 'message': 'ID、タイムスタンプ、アクションは必須です'})
     
+    if new_action not in ACTION_CODES:
+        return jsonify({'success': False, 'message': f'不明なアクションです: {new_action}'})
+
     # タイムスタンプ形式の統一
     try:
         # フロントエンドから送られてくる形式: "YYYY-MM-DDTHH:MM"
-        # データベース保存形式: "YYYY-MM-DD HH:MM:SS"
-        if 'T' in new_timestamp:
-            # ISO形式の場合は変換
-            formatted_timestamp = new_timestamp.replace('T', ' ')
-            if len(formatted_timestamp) == 16:  # "YYYY-MM-DD HH:MM" の場合
-                formatted_timestamp += ':00'  # 秒を追加
-        else:
-            formatted_timestamp = new_timestamp
+        # データベース保存形式: "YYYY-MM-DD HH:MM:SS"（ts_epoch / work_date も同時に更新）
+        formatted_timestamp, ts_epoch, work_date = timecard_time_columns(parse_timestamp(new_timestamp))
 
         logger.info(f"タイムスタンプ変換: {new_timestamp} -> {formatted_timestamp}")
 
@@ -1264,23 +3822,33 @@ def update_timecard():
     
     conn = get_db_connection()
     try:
+        target = conn.execute("SELECT employee_id FROM timecard WHERE id = ?", (punch_id,)).fetchone()
+
         # 更新実行
-        conn.execute("""
+        result = conn.execute("""
             UPDATE timecard 
-            SET timestamp = ?, action = ?, break_type = ? 
+            SET timestamp = ?, ts_epoch = ?, work_date = ?, action = ?, break_type = ? 
             WHERE id = ?
-        """, (formatted_timestamp, new_action, new_break_type, punch_id))
+        """, (formatted_timestamp, ts_epoch, work_date, ACTION_CODES[new_action], new_break_type, punch_id))
         
-        if conn.total_changes == 0:
+        # プール接続では total_changes が累積するため、この文の件数で判定する
+        if result.rowcount == 0:
             conn.close()
             return jsonify({'success': False, 'message': '該当する記録が見つかりませんでした'})
             
         conn.commit()
         conn.close()
+        if target:
+            employee_state_cache.invalidate(target['employee_id'])
 
         logger.info(f"打刻記録更新完了: ID={punch_id}, timestamp={formatted_timestamp}")
         return jsonify({'success': True, 'message': '打刻情報を更新しました'})
 
+    except sqlite3.IntegrityError as e:
+        conn.rollback()
+        conn.close()
+        logger.warning(f"打刻記録更新の重複: ID={punch_id}, {e}")
+        return jsonify({'success': False, 'message': f'{punch_validator.get_duplicate_message(new_action)}（出勤・退勤は1日1件のみ登録できます）'})
     except Exception as e:
         conn.rollback()
         conn.close()
@@ -1292,9 +3860,12 @@ def update_timecard():
 def delete_timecard(id: int):
     conn = get_db_connection()
     try:
+        target = conn.execute("SELECT employee_id FROM timecard WHERE id = ?", (id,)).fetchone()
         conn.execute("DELETE FROM timecard WHERE id = ?", (id,))
         conn.commit()
         conn.close()
+        if target:
+            employee_state_cache.invalidate(target['employee_id'])
         return jsonify({'success': True, 'message': '打刻情報を削除しました'})
     except Exception as e:
         conn.close()
@@ -1313,12 +3884,18 @@ def bulk_delete_timecard():
     if not employee_id or not date:
         return jsonify({'success': False, 'message': '従業員IDと日付は必須です'})
     
+    try:
+        work_date = to_work_date(date)
+    except ValueError:
+        return jsonify({'success': False, 'message': '日付の形式が正しくありません'})
+    
     conn = get_db_connection()
     try:
-        result = conn.execute("DELETE FROM timecard WHERE employee_id = ? AND DATE(timestamp) = ?", (employee_id, date))
+        result = conn.execute("DELETE FROM timecard WHERE employee_id = ? AND work_date = ?", (employee_id, work_date))
         deleted_count = result.rowcount
         conn.commit()
         conn.close()
+        employee_state_cache.invalidate(employee_id)
         return jsonify({'success': True, 'message': f'{deleted_count}件の打刻記録を削除しました'})
     except Exception as e:
         conn.close()
@@ -1326,34 +3903,65 @@ def bulk_delete_timecard():
 
 @app.route('/qr/<employee_id>')
 def get_qr_code(employee_id: str):
-    path = os.path.join(app.root_path, app.config['QR_FOLDER'], f'{employee_id}.png')
-    if os.path.exists(path):
-        return send_file(path, mimetype='image/png')
-    return "QR code not found", 404
+    """
+    従業員のQRコードを表示時に生成して返す
+
+    ?format=png|svg、?scale=1〜QR_MAX_SCALE（1モジュールのサイズ）、?ec=L|M|Q|H（誤り訂正レベル）
+    """
+    fmt = request.args.get('format', 'png').lower()
+    error_correction = request.args.get('ec', 'M').upper()
+    try:
+        scale = int(request.args.get('scale', QR_DEFAULT_SCALE))
+    except ValueError:
+        return "Invalid scale", 400
+    if fmt not in QR_FORMATS or error_correction not in QR_ERROR_CORRECTION_LEVELS or not 1 <= scale <= QR_MAX_SCALE:
+        return "Invalid parameters", 400
+    if not employee_directory.get(employee_id):
+        return "QR code not found", 404
+
+    data, etag = render_qr_code(employee_id, fmt, scale, error_correction)
+    response = Response(data, mimetype=QR_FORMATS[fmt])
+    response.set_etag(etag)
+    response.make_conditional(request)
+    # 削除された従業員のQRコードを表示し続けないよう、ETagで毎回再検証させる
+    return _with_cache_control(response, immutable=False, private=False)
 
 # 写真配信ルート（既存のserve_photo関数を置き換え）
-@app.route('/static/photos/<filename>')
-def serve_photo(filename: str):
-    """写真ファイルの配信（セキュリティ強化版）"""
+@app.route('/static/photos/<path:key>')
+def serve_photo(key: str):
+    """
+    写真ファイルの配信（セキュリティ強化版）
+
+    key は日付別の保存形式（YYYY/MM/DD/<hash>.jpg）または旧形式のファイル名。
+    ?size=small / medium で縮小版を返す（初回要求時に作成してディスクにキャッシュ）。
+    """
     try:
-        # セキュリティ: ファイル名のサニタイズ
-        filename = os.path.basename(filename)  # パストラバーサル攻撃防止
+        size = request.args.get('size', 'original')
+        if size != 'original' and size not in PHOTO_VARIANT_SIZES:
+            return "Invalid size", 400
         
-        # ファイル拡張子の確認
-        allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif'}
-        file_ext = os.path.splitext(filename)[1].lower()
-        if file_ext not in allowed_extensions:
+        # セキュリティ: 拡張子の確認とパストラバーサル攻撃防止
+        photo_path = resolve_photo_file(key)
+        if photo_path is None:
             return "Invalid file type", 400
         
-        photo_path = os.path.join(app.root_path, app.config['PHOTO_FOLDER'], filename)
-        
-        if os.path.exists(photo_path):
+        if os.path.isfile(photo_path):
             # ファイルサイズチェック (最大10MB)
             file_size = os.path.getsize(photo_path)
             if file_size > MAX_PHOTO_SIZE:
                 return "File too large", 413
 
-            return send_file(photo_path, mimetype='image/jpeg', as_attachment=False)
+            # 内容ハッシュ名の写真は内容が変わらないため、ハッシュをETagにして長期キャッシュ
+            match = CONTENT_ADDRESSED_PHOTO_KEY.match(key)
+
+            if size != 'original':
+                photo_path = ensure_photo_variant(photo_path, key, size)
+
+            # 再圧縮（maintain_photos）で内容が変わった場合に備え、ファイルサイズもETagに含める
+            etag = f"{match.group(1)}-{size}-{os.path.getsize(photo_path):x}" if match else None
+
+            return send_cached_file(photo_path, 'image/jpeg', etag=etag,
+                                    immutable=match is not None, private=True)
         else:
             logger.warning(f"写真ファイルが見つかりません: {photo_path}")
             return "Photo not found", 404
@@ -1361,28 +3969,190 @@ def serve_photo(filename: str):
         logger.error(f"写真配信エラー: {e}")
         return "Error serving photo", 500
 
+# === 顔認証モデルの配信 ===
+# face-api.js の loadFromUri はモデルごとに「<URL>/<モデル名>-weights_manifest.json」と
+# その shard を読み込むため、モデルごとの内容ハッシュをディレクトリ名にして配信する。
+# 内容が変わればURLも変わるので、ブラウザには immutable で永続的にキャッシュさせる。
+
+def build_face_models(source: str = FACE_MODEL_SOURCE_FOLDER,
+                      destination: str = FACE_MODEL_BUILD_FOLDER) -> Dict[str, str]:
+    """
+    face-api.js のモデルをフィンガープリント付きディレクトリへ出力し、gzip / brotli で事前圧縮
+
+    戻り値（と destination/manifest.json）は {モデル名: フィンガープリント}。
+    brotli パッケージがない場合は gzip のみ作成する。使われなくなった出力は削除する。
+    """
+    try:
+        import brotli  # type: ignore
+    except ImportError:
+        brotli = None
+        logger.warning("brotli がインストールされていないため、gzip のみ作成します")
+
+    fingerprints: Dict[str, str] = {}
+    suffix = '-weights_manifest.json'
+    for manifest_name in sorted(os.listdir(source)):
+        if not manifest_name.endswith(suffix):
+            continue
+        model = manifest_name[:-len(suffix)]
+        with open(os.path.join(source, manifest_name), 'rb') as f:
+            manifest = f.read()
+        files = [manifest_name] + [path for group in json.loads(manifest) for path in group['paths']]
+
+        digest = hashlib.sha256()
+        for name in files:
+            digest.update(name.encode())
+            with open(os.path.join(source, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(PHOTO_UPLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        fingerprint = digest.hexdigest()[:FACE_MODEL_FINGERPRINT_LENGTH]
+        fingerprints[model] = fingerprint
+
+        output = os.path.join(destination, fingerprint)
+        if os.path.isdir(output):
+            continue
+        temp_output = f"{output}.tmp"
+        shutil.rmtree(temp_output, ignore_errors=True)
+        os.makedirs(temp_output)
+        for name in files:
+            with open(os.path.join(source, name), 'rb') as f:
+                data = f.read()
+            compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+            if brotli:
+                compressed['br'] = brotli.compress(data, quality=11)
+            with open(os.path.join(temp_output, name), 'wb') as f:
+                f.write(data)
+            for encoding, encoded in compressed.items():
+                # 小さくならない形式は作らない（配信時は元のファイルを送る）
+                if len(encoded) < len(data):
+                    with open(os.path.join(temp_output, name + FACE_MODEL_ENCODINGS[encoding]), 'wb') as f:
+                        f.write(encoded)
+        os.replace(temp_output, output)
+        logger.info(f"顔認証モデルを出力しました: {model} -> {fingerprint}")
+
+    manifest_path = os.path.join(destination, 'manifest.json')
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(fingerprints, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+    for name in os.listdir(destination):
+        if name != 'manifest.json' and name not in fingerprints.values():
+            path = os.path.join(destination, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+    return fingerprints
+
+@lru_cache(maxsize=4)
+def _load_face_model_manifest(path: str, mtime_ns: int) -> Dict[str, str]:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def face_model_urls() -> Dict[str, str]:
+    """{モデル名: 読み込み元URL}（build_face_models.py 未実行の場合は空）"""
+    path = os.path.join(FACE_MODEL_BUILD_FOLDER, 'manifest.json')
+    try:
+        fingerprints = _load_face_model_manifest(path, os.stat(path).st_mtime_ns)
+    except (OSError, ValueError):
+        return {}
+    # loadFromUri に渡すディレクトリのURL（ファイル名部分を除く）
+    return {model: url_for('serve_face_model', fingerprint=fingerprint, filename='_').rsplit('/', 1)[0]
+            for model, fingerprint in fingerprints.items()}
+
+@app.context_processor
+def inject_face_model_urls() -> Dict[str, Any]:
+    """テンプレートで face_model_urls を使えるようにする"""
+    return {'face_model_urls': face_model_urls()}
+
+@app.route('/models/<fingerprint>/<filename>')
+def serve_face_model(fingerprint: str, filename: str):
+    """
+    フィンガープリント付きの顔認証モデルを配信
+
+    Accept-Encoding に応じて事前圧縮したファイル（br / gzip）を返す。
+    URLが内容ごとに変わるため immutable で長期キャッシュさせる。
+    """
+    if not re.fullmatch(rf'[0-9a-f]{{{FACE_MODEL_FINGERPRINT_LENGTH}}}', fingerprint):
+        return "Not found", 404
+    path = safe_join(FACE_MODEL_BUILD_FOLDER, fingerprint, filename)
+    if not path or os.path.splitext(filename)[1] in FACE_MODEL_ENCODINGS.values() or not os.path.isfile(path):
+        return "Not found", 404
+    mimetype = 'application/json' if filename.endswith('.json') else 'application/octet-stream'
+
+    available = [encoding for encoding, ext in FACE_MODEL_ENCODINGS.items() if os.path.isfile(path + ext)]
+    encoding = request.accept_encodings.best_match(available) if available else None
+    if encoding:
+        response = send_cached_file(path + FACE_MODEL_ENCODINGS[encoding], mimetype,
+                                    etag=f"{fingerprint}-{filename}-{encoding}",
+                                    immutable=True, content_encoding=encoding)
+    else:
+        response = send_cached_file(path, mimetype, etag=f"{fingerprint}-{filename}", immutable=True)
+        if available:
+            response.vary.add('Accept-Encoding')
+    return response
+
 # === エクスポート機能（勤務時間計算削除） ===
 
+# 日別勤怠サマリー（employees 1行につき1行、work_date で絞り込み）
+# {{timecard}} には timecard_for_month() のテーブル式を埋め込む
+DAILY_SUMMARY_QUERY = f'''
+    SELECT 
+        e.employee_id,
+        e.name,
+        MIN(CASE WHEN t.action = {ACTION_CODES['in']} THEN t.timestamp END) as check_in,
+        MAX(CASE WHEN t.action = {ACTION_CODES['out']} THEN t.timestamp END) as check_out,
+        MIN(CASE WHEN t.action = {ACTION_CODES['out_personal']} THEN t.timestamp END) as exit_time,
+        MAX(CASE WHEN t.action = {ACTION_CODES['in_personal']} THEN t.timestamp END) as return_time
+    FROM employees e
+    LEFT JOIN {{timecard}} t ON e.employee_id = t.employee_id 
+        AND t.work_date = ?
+    GROUP BY e.employee_id, e.name
+    ORDER BY e.employee_id
+'''
+
+def iter_csv_rows(cursor: sqlite3.Cursor, fetch_size: int = CSV_EXPORT_FETCH_SIZE) -> Iterator[bytes]:
+    """
+    クエリ結果をBOM付きUTF-8のCSVとして少しずつ返す（列名はSELECTの列名）
+
+    fetch_size 行ずつ読み込んで書き出すため、件数が増えてもメモリ使用量は増えない。
+    BOMはExcelで文字化けさせないために先頭へ1回だけ付ける。
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(column[0] for column in cursor.description)
+    yield codecs.BOM_UTF8 + buffer.getvalue().encode('utf-8')
+
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+def csv_download(chunks: Iterator[bytes], filename: str) -> Response:
+    """CSVを逐次送信するレスポンス（生成が終わるまでリクエストコンテキストと接続を保持）"""
+    return Response(stream_with_context(chunks), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @app.route('/api/employees/export-csv')
 @login_required
 def export_employees_csv():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT employee_id, name, factory, employment_type FROM employees", conn)
-    conn.close()
-    
-    csv_buffer = io.StringIO()
-    df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
-    csv_buffer.seek(0)
-    
-    return send_file(io.BytesIO(csv_buffer.getvalue().encode('utf-8-sig')),
-                     mimetype='text/csv',
-                     as_attachment=True,
-                     download_name='employees.csv')
+    conn = get_report_connection()
+
+    def generate() -> Iterator[bytes]:
+        try:
+            with closing(conn.execute("SELECT employee_id, name, factory, employment_type FROM employees")) as cursor:
+                yield from iter_csv_rows(cursor)
+        finally:
+            conn.close()
+
+    return csv_download(generate(), 'employees.csv')
 
 @app.route('/api/employees/export-excel')
 @login_required
 def export_employees_excel():
-    conn = get_db_connection()
+    conn = get_report_connection()
     df = pd.read_sql_query("SELECT employee_id, name, factory, employment_type FROM employees", conn)
     conn.close()
     
@@ -1396,23 +4166,198 @@ def export_employees_excel():
                      as_attachment=True,
                      download_name='employees.xlsx')
 
+_qr_badge_pool: Optional[ProcessPoolExecutor] = None
+_qr_badge_pool_lock = threading.Lock()
+
+def qr_badge_pool(broken: Optional[ProcessPoolExecutor] = None) -> ProcessPoolExecutor:
+    """
+    名札の描画に使うプロセスプール（初回に作成し、全リクエストで共有）
+
+    fork ではリクエスト処理中のスレッドやロック、DB接続を子プロセスが引き継ぐため spawn で起動する。
+    broken に壊れたプール（ワーカーの異常終了など）を渡すと作り直す。
+    """
+    global _qr_badge_pool
+    with _qr_badge_pool_lock:
+        if _qr_badge_pool is not None and _qr_badge_pool is broken:
+            _qr_badge_pool.shutdown(wait=False, cancel_futures=True)
+            _qr_badge_pool = None
+        if _qr_badge_pool is None:
+            _qr_badge_pool = ProcessPoolExecutor(max_workers=QR_BADGE_WORKERS,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return _qr_badge_pool
+
+def shutdown_qr_badge_pool() -> None:
+    """名札描画用のプロセスプールを停止（終了時）"""
+    global _qr_badge_pool
+    with _qr_badge_pool_lock:
+        pool, _qr_badge_pool = _qr_badge_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+atexit.register(shutdown_qr_badge_pool)
+
+@contextmanager
+def qr_badge_renderer(task_count: int) -> Iterator[Callable[..., Iterator[Any]]]:
+    """名札の描画に使う map 関数（件数が多い場合は共有のプロセスプールで並列に描画）"""
+    workers = min(QR_BADGE_WORKERS, task_count)
+    if task_count < QR_BADGE_POOL_MIN_TASKS or workers <= 1:
+        yield map
+        return
+    chunksize = max(1, task_count // (workers * 4))
+    futures: List[Future] = []
+
+    def render(func: Callable[..., Any], *iterables: Iterable[Any]) -> Iterator[Any]:
+        arguments = list(zip(*iterables))
+        pool = qr_badge_pool()
+        submitted: List[Future] = []
+        for start in range(0, len(arguments), chunksize):
+            chunk = arguments[start:start + chunksize]
+            try:
+                future = pool.submit(qr_badges.render_chunk, func, chunk)
+            except BrokenProcessPool:
+                pool = qr_badge_pool(broken=pool)
+                future = pool.submit(qr_badges.render_chunk, func, chunk)
+            submitted.append(future)
+        futures.extend(submitted)
+        return (result for future in submitted for result in future.result())
+
+    try:
+        yield render
+    finally:
+        # ダウンロードが中断された場合は残りの描画を取り消す（プールは他のリクエストと共有するため停止しない）
+        for future in futures:
+            future.cancel()
+
+@app.route('/api/employees/qr-badges')
+@login_required
+def export_qr_badges():
+    """
+    QRコード名札の一括出力
+
+    ?format=pdf: A4に名札（QRコード・氏名・従業員ID）を並べた印刷用PDF
+    ?format=zip: 名札ごとのPNGをまとめたZIP
+    ?factory= / ?employment_type= で対象を絞り込める。描画はプロセスプールで並列に行い、
+    描画できたページから順に送信する。
+    """
+    fmt = request.args.get('format', 'pdf').lower()
+    if fmt not in ('pdf', 'zip'):
+        return jsonify({'success': False, 'message': '出力形式は pdf または zip を指定してください'}), 400
+    factory = request.args.get('factory')
+    employment_type = request.args.get('employment_type')
+
+    employees: List[qr_badges.BadgeEmployee] = [
+        (str(emp['employee_id']), emp['name'] or '', emp['factory'] or '')
+        for emp in employee_directory.list_all()
+        if (not factory or emp['factory'] == factory)
+        and (not employment_type or emp['employment_type'] == employment_type)
+    ]
+    if not employees:
+        return jsonify({'success': False, 'message': '対象の従業員がいません'}), 404
+
+    font_path = qr_badges.find_badge_font()
+    if not font_path:
+        logger.warning("名札用の日本語フォントが見つかりません。BADGE_FONT_PATH を設定してください")
+
+    def generate() -> Iterator[bytes]:
+        buffer = qr_badges.StreamBuffer()
+        if fmt == 'zip':
+            with qr_badge_renderer(len(employees)) as render, \
+                    zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                # PNGは圧縮済みのため無圧縮で格納
+                for employee, png in zip(employees, render(qr_badges.render_badge_png, employees, repeat(font_path))):
+                    archive.writestr(f"{secure_filename(employee[0]) or 'employee'}.png", png)
+                    yield from buffer.drain()
+        else:
+            pages = qr_badges.chunk_pages(employees)
+            writer = qr_badges.PdfPageWriter(buffer)
+            with qr_badge_renderer(len(pages)) as render:
+                for page in render(qr_badges.render_badge_page, pages, repeat(font_path)):
+                    writer.add_page(page)
+                    yield from buffer.drain()
+            writer.close()
+        yield from buffer.drain()
+
+    filename = f"qr_badges_{datetime.now(JST).strftime('%Y%m%d')}.{fmt}"
+    return Response(generate(), mimetype='application/pdf' if fmt == 'pdf' else 'application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @app.route('/api/timecard/export-csv')
 @login_required
 def export_timecard_csv():
     date_str = request.args.get('date')
-    conn = get_db_connection()
-    
-    df = pd.read_sql_query("SELECT T.timestamp, E.employee_id, E.name, T.action, T.location FROM timecard AS T JOIN employees AS E ON T.employee_id = E.employee_id WHERE T.timestamp LIKE ? ORDER BY T.timestamp", conn, params=(f'{date_str}%',))
-    conn.close()
-    
-    csv_buffer = io.StringIO()
-    df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
-    csv_buffer.seek(0)
-    
-    return send_file(io.BytesIO(csv_buffer.getvalue().encode('utf-8-sig')),
-                     mimetype='text/csv',
-                     as_attachment=True,
-                     download_name=f'timecard_{date_str}.csv')
+    if not date_str:
+        return jsonify({'error': 'Date is required'}), 400
+    try:
+        work_date = to_work_date(date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+
+    conn = get_report_connection()
+
+    def generate() -> Iterator[bytes]:
+        try:
+            with timecard_for_month(conn, work_date // 100) as timecard:
+                # アーカイブをDETACHする前にカーソルを閉じる（ダウンロードが中断された場合も）
+                with closing(conn.execute(f"""
+                    SELECT T.timestamp, E.employee_id, E.name, action_name(T.action) AS action, location_name(T.location) AS location
+                    FROM {timecard} AS T
+                    JOIN employees AS E ON T.employee_id = E.employee_id
+                    WHERE T.work_date = ?
+                    ORDER BY T.ts_epoch, T.id
+                """, (work_date,))) as cursor:
+                    yield from iter_csv_rows(cursor)
+        finally:
+            conn.close()
+
+    return csv_download(generate(), f'timecard_{date_str}.csv')
+
+# 月次レポートの打刻列（action -> 列名）
+MONTHLY_REPORT_PUNCH_COLUMNS: Dict[str, str] = {
+    'in': '出勤',
+    'out': '退勤',
+    'out_personal': '退出',
+    'in_personal': '戻り'
+}
+WEEKDAY_NAMES = np.array(['月', '火', '水', '木', '金', '土', '日'])
+
+def build_monthly_report(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    月次レポートの表（従業員・日付ごとに1行、従業員ID・日付順）を作成
+
+    df は timestamp / employee_id / name / action 列を持つ打刻記録で、従業員ID・打刻順に並んでいること。
+    出勤・退勤・退出・戻りはその日の最後の該当打刻の時刻（HH:MM）、なければ空文字。
+    行ごとのループを使わず、(従業員ID, 日付, action) ごとの最後の時刻を列に展開して作成する。
+    """
+    # タイムスタンプは保存時に 'YYYY-MM-DD HH:MM:SS' へ正規化済み
+    timestamps = pd.to_datetime(df['timestamp'], format='%Y-%m-%d %H:%M:%S')
+    punches = pd.DataFrame({
+        'employee_id': df['employee_id'],
+        'name': df['name'],
+        'action': df['action'],
+        'date': timestamps.dt.normalize(),
+        'time': df['timestamp'].str.slice(11, 16)
+    })
+    keys = ['employee_id', 'date']
+
+    # 氏名はその日の最初の打刻の行から取る
+    days = punches.drop_duplicates(keys).sort_values(keys, kind='stable').set_index(keys)['name']
+    times = (punches[punches['action'].isin(list(MONTHLY_REPORT_PUNCH_COLUMNS))]
+             .groupby(keys + ['action'], sort=False)['time'].last()
+             .unstack('action')
+             .reindex(index=days.index, columns=list(MONTHLY_REPORT_PUNCH_COLUMNS))
+             .fillna(''))
+
+    dates = days.index.get_level_values('date')
+    # 勤務時間計算機能を削除
+    report = pd.DataFrame({
+        '日付': dates.strftime('%Y/%m/%d'),
+        '曜日': WEEKDAY_NAMES[dates.weekday],
+        '従業員ID': days.index.get_level_values('employee_id'),
+        '氏名': days.to_numpy()
+    })
+    for action, column in MONTHLY_REPORT_PUNCH_COLUMNS.items():
+        report[column] = times[action].to_numpy()
+    return report
 
 @app.route('/api/timecard/monthly-report-excel')
 @login_required
@@ -1422,70 +4367,27 @@ def export_monthly_report():
     if not year_str or not month_str:
         return jsonify({'error': 'Year and month are required'}), 400
 
-    conn = get_db_connection()
-    query = """
-        SELECT T.timestamp, E.employee_id, E.name, T.action, T.break_type
-        FROM timecard AS T
-        JOIN employees AS E ON T.employee_id = E.employee_id
-        WHERE SUBSTR(T.timestamp, 1, 4) = ? AND SUBSTR(T.timestamp, 6, 2) = ?
-        ORDER BY E.employee_id, T.timestamp
-    """
-    df = pd.read_sql_query(query, conn, params=(year_str, month_str.zfill(2)))
+    try:
+        month_start = int(year_str) * 10000 + int(month_str) * 100
+    except ValueError:
+        return jsonify({'error': 'Invalid year or month'}), 400
+
+    conn = get_report_connection()
+    with timecard_for_month(conn, month_start // 100) as timecard:
+        query = f"""
+            SELECT T.timestamp, E.employee_id, E.name, action_name(T.action) AS action, T.break_type
+            FROM {timecard} AS T
+            JOIN employees AS E ON T.employee_id = E.employee_id
+            WHERE T.work_date BETWEEN ? AND ?
+            ORDER BY E.employee_id, T.ts_epoch, T.id
+        """
+        df = pd.read_sql_query(query, conn, params=(month_start + 1, month_start + 31))
     conn.close()
 
     if df.empty:
         return jsonify({'error': 'No data for this month'}), 404
 
-    def clean_timestamp_format(ts_str):
-        """ 'YYYY-MM-DD HH:MM:SS:ms' を 'YYYY-MM-DD HH:MM:SS.ms' に変換する """
-        if isinstance(ts_str, str) and ts_str.count(':') > 2:
-            # 文字列の最後のコロンだけをピリオドに置換する
-            parts = ts_str.rpartition(':')
-            return parts[0] + '.' + parts[2]
-        return ts_str
-
-    # タイムスタンプ文字列をクリーンな形式に変換
-    df['timestamp'] = df['timestamp'].apply(clean_timestamp_format)
-
-    # クリーンになった文字列をdatetimeオブジェクトに変換
-    # この行は元のコードと同じですが、上記の処理の後に実行します
-    df['timestamp'] = pd.to_datetime(df['timestamp'], format='mixed')
-    df['date'] = df['timestamp'].dt.date
-    df['time'] = df['timestamp'].dt.time
-
-    summary_data = []
-    
-    for (employee_id, date), group in df.groupby(['employee_id', 'date']):
-        employee_name = group.iloc[0]['name']
-        
-        punches = {}
-        
-        for _, row in group.iterrows():
-            action = row['action']
-            time_str = row['time'].strftime('%H:%M')
-            
-            if action == 'in':
-                punches['出勤'] = time_str
-            elif action == 'out':
-                punches['退勤'] = time_str
-            elif action == 'out_personal':
-                punches['退出'] = time_str
-            elif action == 'in_personal':  
-                punches['戻り'] = time_str
-        
-        # 勤務時間計算機能を削除
-        summary_data.append({
-            '日付': date.strftime('%Y/%m/%d'),
-            '曜日': ['月', '火', '水', '木', '金', '土', '日'][date.weekday()],
-            '従業員ID': employee_id,
-            '氏名': employee_name,
-            '出勤': punches.get('出勤', ''),
-            '退勤': punches.get('退勤', ''),
-            '退出': punches.get('退出', ''),
-            '戻り': punches.get('戻り', '')
-        })
-
-    summary_df = pd.DataFrame(summary_data)
+    summary_df = build_monthly_report(df)
     
     excel_buffer = io.BytesIO()
     with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -1520,24 +4422,15 @@ def export_timecard_excel():
     if not date_str:
         return jsonify({'error': 'Date is required'}), 400
         
-    conn = get_db_connection()
-    
-    query = '''
-        SELECT 
-            e.employee_id,
-            e.name,
-            MIN(CASE WHEN t.action = 'in' THEN t.timestamp END) as check_in,
-            MAX(CASE WHEN t.action = 'out' THEN t.timestamp END) as check_out,
-            MIN(CASE WHEN t.action = 'out_personal' THEN t.timestamp END) as exit_time,
-            MAX(CASE WHEN t.action = 'in_personal' THEN t.timestamp END) as return_time
-        FROM employees e
-        LEFT JOIN timecard t ON e.employee_id = t.employee_id 
-            AND DATE(t.timestamp) = ?
-        GROUP BY e.employee_id, e.name
-        ORDER BY e.employee_id
-    '''
+    try:
+        work_date = to_work_date(date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+
+    conn = get_report_connection()
     
-    df = pd.read_sql_query(query, conn, params=(date_str,))
+    with timecard_for_month(conn, work_date // 100) as timecard:
+        df = pd.read_sql_query(DAILY_SUMMARY_QUERY.format(timecard=timecard), conn, params=(work_date,))
     conn.close()
     
     formatted_data = []
@@ -1582,25 +4475,16 @@ def get_daily_summary():
     if not date_str:
         return jsonify([])
     
-    conn = get_db_connection()
+    try:
+        work_date = to_work_date(date_str)
+    except ValueError:
+        return jsonify([])
     
-    # 日付ごとの勤怠サマリーを取得（勤務時間計算機能削除版）
-    query = '''
-        SELECT 
-            e.employee_id,
-            e.name,
-            MIN(CASE WHEN t.action = 'in' THEN t.timestamp END) as check_in,
-            MAX(CASE WHEN t.action = 'out' THEN t.timestamp END) as check_out,
-            MIN(CASE WHEN t.action = 'out_personal' THEN t.timestamp END) as exit_time,
-            MAX(CASE WHEN t.action = 'in_personal' THEN t.timestamp END) as return_time
-        FROM employees e
-        LEFT JOIN timecard t ON e.employee_id = t.employee_id 
-            AND DATE(t.timestamp) = ?
-        GROUP BY e.employee_id, e.name
-        ORDER BY e.employee_id
-    '''
+    conn = get_report_connection()
     
-    records = conn.execute(query, (date_str,)).fetchall()
+    # 日付ごとの勤怠サマリーを取得（勤務時間計算機能削除版）
+    with timecard_for_month(conn, work_date // 100) as timecard:
+        records = conn.execute(DAILY_SUMMARY_QUERY.format(timecard=timecard), (work_date,)).fetchall()
     conn.close()
     
     result = []
@@ -1632,22 +4516,26 @@ def get_timecard_detail():
     
     if not employee_id or not date_str:
         return jsonify({'error': 'employee_id and date are required'}), 400
-    
-    conn = get_db_connection()
+    try:
+        work_date = to_work_date(date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
     
     # 従業員名を取得
-    employee = conn.execute('SELECT name FROM employees WHERE employee_id = ?', (employee_id,)).fetchone()
+    employee = employee_directory.get(employee_id)
     if not employee:
-        conn.close()
         return jsonify({'error': 'Employee not found'}), 404
     
-    # その日の打刻詳細を取得（修正：break_typeを削除）
-    punches = conn.execute('''
-        SELECT id, timestamp, action, photo_path, location
-        FROM timecard 
-        WHERE employee_id = ? AND DATE(timestamp) = ?
-        ORDER BY timestamp ASC
-    ''', (employee_id, date_str)).fetchall()
+    conn = get_db_connection()
+    
+    # その日の打刻詳細を取得（修正：break_typeを削除、アーカイブ済みの月も参照）
+    with timecard_for_month(conn, work_date // 100) as timecard:
+        punches = conn.execute(f'''
+            SELECT id, timestamp, action_name(action) AS action, photo_path, location_name(location) AS location
+            FROM {timecard} 
+            WHERE employee_id = ? AND work_date = ?
+            ORDER BY ts_epoch ASC, id ASC
+        ''', (employee_id, work_date)).fetchall()
     
     conn.close()
     
@@ -1655,7 +4543,11 @@ def get_timecard_detail():
         'employee_name': employee['name'],
         'employee_id': employee_id,
         'date': date_str,
-        'punches': [dict(punch) for punch in punches]
+        'punches': [
+            # 写真の処理待ちは photo_path を返さず photo_pending で示す
+            dict(punch, photo_path=None, photo_pending=True) if is_pending_photo(punch['photo_path']) else dict(punch)
+            for punch in punches
+        ]
     })
 
 # === デバッグ用API（新規追加） ===
@@ -1668,27 +4560,27 @@ def debug_timecard_data():
         date_str = request.args.get('date', datetime.now(JST).strftime('%Y-%m-%d'))
         employee_id = request.args.get('employee_id', 'TEST001')
         
-        conn = get_db_connection()
+        conn = get_report_connection()
         
         # 全打刻データの確認
-        all_punches = conn.execute('''
-            SELECT * FROM timecard 
-            ORDER BY timestamp DESC 
+        all_punches = conn.execute(f'''
+            SELECT {TIMECARD_COLUMNS} FROM timecard 
+            ORDER BY ts_epoch DESC 
             LIMIT 50
         ''').fetchall()
         
         # 特定日の打刻データ
-        daily_punches = conn.execute('''
-            SELECT * FROM timecard 
-            WHERE DATE(timestamp) = ?
-            ORDER BY timestamp DESC
-        ''', (date_str,)).fetchall()
+        daily_punches = conn.execute(f'''
+            SELECT {TIMECARD_COLUMNS} FROM timecard 
+            WHERE work_date = ?
+            ORDER BY ts_epoch DESC
+        ''', (to_work_date(date_str),)).fetchall()
         
         # 特定従業員の打刻データ
-        employee_punches = conn.execute('''
-            SELECT * FROM timecard 
+        employee_punches = conn.execute(f'''
+            SELECT {TIMECARD_COLUMNS} FROM timecard 
             WHERE employee_id = ?
-            ORDER BY timestamp DESC 
+            ORDER BY ts_epoch DESC 
             LIMIT 20
         ''', (employee_id,)).fetchall()
         
@@ -1725,8 +4617,9 @@ def debug_daily_summary():
     """デバッグ用: 日別サマリー取得処理の詳細確認"""
     try:
         date_str = request.args.get('date', datetime.now(JST).strftime('%Y-%m-%d'))
+        work_date = to_work_date(date_str)
         
-        conn = get_db_connection()
+        conn = get_report_connection()
         
         # 元のクエリを分解して確認
         employees_query = "SELECT * FROM employees ORDER BY employee_id"
@@ -1739,32 +4632,32 @@ def debug_daily_summary():
             employee_id = emp['employee_id']
             
             # その従業員の当日の全打刻
-            punches = conn.execute('''
-                SELECT * FROM timecard 
-                WHERE employee_id = ? AND DATE(timestamp) = ?
-                ORDER BY timestamp ASC
-            ''', (employee_id, date_str)).fetchall()
+            punches = conn.execute(f'''
+                SELECT {TIMECARD_COLUMNS} FROM timecard 
+                WHERE employee_id = ? AND work_date = ?
+                ORDER BY ts_epoch ASC, id ASC
+            ''', (employee_id, work_date)).fetchall()
             
             # 各アクション別の最初/最後の時刻
             check_in = conn.execute('''
                 SELECT MIN(timestamp) as time FROM timecard 
-                WHERE employee_id = ? AND DATE(timestamp) = ? AND action = 'in'
-            ''', (employee_id, date_str)).fetchone()
+                WHERE employee_id = ? AND work_date = ? AND action = ?
+            ''', (employee_id, work_date, ACTION_CODES['in'])).fetchone()
             
             check_out = conn.execute('''
                 SELECT MAX(timestamp) as time FROM timecard 
-                WHERE employee_id = ? AND DATE(timestamp) = ? AND action = 'out'
-            ''', (employee_id, date_str)).fetchone()
+                WHERE employee_id = ? AND work_date = ? AND action = ?
+            ''', (employee_id, work_date, ACTION_CODES['out'])).fetchone()
             
             exit_time = conn.execute('''
                 SELECT MIN(timestamp) as time FROM timecard 
-                WHERE employee_id = ? AND DATE(timestamp) = ? AND action = 'out_personal'
-            ''', (employee_id, date_str)).fetchone()
+                WHERE employee_id = ? AND work_date = ? AND action = ?
+            ''', (employee_id, work_date, ACTION_CODES['out_personal'])).fetchone()
             
             return_time = conn.execute('''
                 SELECT MAX(timestamp) as time FROM timecard 
-                WHERE employee_id = ? AND DATE(timestamp) = ? AND action = 'in_personal'
-            ''', (employee_id, date_str)).fetchone()
+                WHERE employee_id = ? AND work_date = ? AND action = ?
+            ''', (employee_id, work_date, ACTION_CODES['in_personal'])).fetchone()
             
             detailed_results.append({
                 'employee_id': employee_id,
@@ -1778,22 +4671,7 @@ def debug_daily_summary():
             })
         
         # 元のサマリークエリも実行
-        original_query = '''
-            SELECT 
-                e.employee_id,
-                e.name,
-                MIN(CASE WHEN t.action = 'in' THEN t.timestamp END) as check_in,
-                MAX(CASE WHEN t.action = 'out' THEN t.timestamp END) as check_out,
-                MIN(CASE WHEN t.action = 'out_personal' THEN t.timestamp END) as exit_time,
-                MAX(CASE WHEN t.action = 'in_personal' THEN t.timestamp END) as return_time
-            FROM employees e
-            LEFT JOIN timecard t ON e.employee_id = t.employee_id 
-                AND DATE(t.timestamp) = ?
-            GROUP BY e.employee_id, e.name
-            ORDER BY e.employee_id
-        '''
-        
-        original_result = conn.execute(original_query, (date_str,)).fetchall()
+        original_result = conn.execute(DAILY_SUMMARY_QUERY.format(timecard='timecard'), (work_date,)).fetchall()
         
         conn.close()
         
@@ -1833,17 +4711,10 @@ def debug_test_punch():
         
         if is_valid:
             # テスト打刻実行
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO timecard (employee_id, timestamp, action, location) 
-                VALUES (?, ?, ?, ?)
-            """, (employee_id, timestamp_str, action, 'テスト'))
-            
-            conn.commit()
+            inserted_id = record_punch(conn, employee_id, action, now, 'テスト')
             
             # 打刻後の確認
-            inserted_id = cursor.lastrowid
-            inserted_record = conn.execute("SELECT * FROM timecard WHERE id = ?", (inserted_id,)).fetchone()
+            inserted_record = conn.execute(f"SELECT {TIMECARD_COLUMNS} FROM timecard WHERE id = ?", (inserted_id,)).fetchone()
             
             # 打刻後の状態確認
             after_state = punch_validator.get_employee_state(employee_id, now.strftime('%Y-%m-%d'))
@@ -1878,7 +4749,7 @@ def debug_test_punch():
 @app.route('/api/debug/photos', methods=['GET'])
 @login_required
 def debug_photos():
-    """デバッグ用: 写真保存状況確認"""
+    """デバッグ用: 写真保存状況確認（?date=YYYY-MM-DD の日付ディレクトリのみ走査、既定は当日）"""
     try:
         photo_folder = os.path.join(app.root_path, app.config['PHOTO_FOLDER'])
         
@@ -1888,18 +4759,24 @@ def debug_photos():
                 'photo_folder': photo_folder
             })
         
+        date_str = request.args.get('date', datetime.now(JST).strftime('%Y-%m-%d'))
+        day_key = datetime.strptime(date_str, '%Y-%m-%d').strftime('%Y/%m/%d')
+        day_folder = os.path.join(photo_folder, day_key)
+        
         # 写真ファイル一覧
         photo_files = []
-        for filename in os.listdir(photo_folder):
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                file_path = os.path.join(photo_folder, filename)
-                file_stat = os.stat(file_path)
-                photo_files.append({
-                    'filename': filename,
-                    'size': file_stat.st_size,
-                    'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
-                    'url': f'/static/photos/{filename}'
-                })
+        if os.path.isdir(day_folder):
+            with os.scandir(day_folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith(tuple(PHOTO_EXTENSIONS)):
+                        file_stat = entry.stat()
+                        key = f"{day_key}/{entry.name}"
+                        photo_files.append({
+                            'filename': key,
+                            'size': file_stat.st_size,
+                            'created': datetime.fromtimestamp(file_stat.st_ctime).isoformat(),
+                            'url': f'/static/photos/{key}'
+                        })
         
         # データベース内の写真パス確認
         conn = get_db_connection()
@@ -1907,16 +4784,18 @@ def debug_photos():
             SELECT employee_id, timestamp, photo_path 
             FROM timecard 
             WHERE photo_path IS NOT NULL 
-            ORDER BY timestamp DESC 
+            ORDER BY ts_epoch DESC 
             LIMIT 20
         ''').fetchall()
         conn.close()
         
         return jsonify({
             'photo_folder': photo_folder,
+            'date': date_str,
             'photo_files_count': len(photo_files),
             'photo_files': photo_files,
-            'db_photos': [dict(row) for row in db_photos]
+            'db_photos': [dict(row) for row in db_photos],
+            'photo_processor': photo_processor.stats()
         })
         
     except Exception as e:
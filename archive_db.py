@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+打刻記録の月別アーカイブツール
+
+締め済みの月（当月と直近 ARCHIVE_KEEP_MONTHS か月を除く）の打刻記録を
+PERSISTENT_STORAGE_PATH/archive/timecard_YYYYMM.db へ移動し、ホットDBを小さく保つ。
+
+使い方:
+    python archive_db.py             # アーカイブを実行
+    python archive_db.py --vacuum    # アーカイブ後にホットDBをVACUUMして容量を解放
+"""
+
+import argparse
+import os
+import sys
+
+from app import ARCHIVE_FOLDER, DB_PATH, archive_closed_months, archive_cutoff_month, get_db_connection
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='勤怠管理システム 打刻記録アーカイブツール')
+    parser.add_argument('--vacuum', action='store_true', help='アーカイブ後にホットDBをVACUUMする')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        print("データベースファイルが見つかりません。")
+        sys.exit(1)
+
+    print(f"データベース: {DB_PATH}")
+    print(f"アーカイブ先: {ARCHIVE_FOLDER}")
+    print(f"対象: {archive_cutoff_month()} より前の月")
+
+    conn = get_db_connection()
+    try:
+        moved = archive_closed_months(conn)
+        if args.vacuum and moved:
+            print("VACUUMを実行中...")
+            conn.execute("VACUUM")
+    except Exception as e:
+        print(f"アーカイブエラー: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    if not moved:
+        print("アーカイブ対象の月はありません")
+        return
+
+    for month, count in moved.items():
+        print(f"  - {month}: {count}件")
+    print("アーカイブ完了")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+月次レポート作成のベンチマーク
+
+1か月分の打刻記録（既定で従業員1,000人・平日のみ）をメモリ上に生成し、
+build_monthly_report() と従来の groupby + iterrows による作成を比較する。
+両者の結果が完全に一致することも確認する。DBは使用しない。
+
+使い方:
+    python benchmark_monthly_report.py                   # 従業員1,000人で比較
+    python benchmark_monthly_report.py --employees 3000  # 人数を変更
+"""
+
+import argparse
+import calendar
+import random
+import sys
+import time
+from typing import Callable, List
+
+import pandas as pd  # type: ignore
+
+from app import build_monthly_report
+
+
+def generate_month(year: int, month: int, employees: int, seed: int = 0) -> pd.DataFrame:
+    """月次レポートのクエリ結果と同じ形式・並び順の打刻記録を生成"""
+    rng = random.Random(seed)
+    rows: List[tuple] = []
+    days = [day for day in range(1, calendar.monthrange(year, month)[1] + 1)
+            if calendar.weekday(year, month, day) < 5]
+    for index in range(employees):
+        employee_id = f'E{index:05d}'
+        name = f'従業員{index}'
+        for day in days:
+            if rng.random() < 0.05:  # 欠勤
+                continue
+            date = f'{year:04d}-{month:02d}-{day:02d}'
+            punches = [(8 * 60 + rng.randrange(-20, 10), 'in'),
+                       (8 * 60 + 15, 'break_out'), (8 * 60 + 30, 'break_in'),
+                       (12 * 60, 'break_out'), (13 * 60, 'break_in'),
+                       (15 * 60 + 15, 'break_out'), (15 * 60 + 30, 'break_in'),
+                       (17 * 60 + rng.randrange(0, 120), 'out')]
+            if rng.random() < 0.2:  # 私用外出
+                leave = 10 * 60 + rng.randrange(0, 60)
+                punches += [(leave, 'out_personal'), (leave + rng.randrange(10, 60), 'in_personal')]
+            if rng.random() < 0.02:  # 打刻のやり直し
+                punches.append((8 * 60 + rng.randrange(10, 30), 'in'))
+            for minutes, action in sorted(punches):
+                rows.append((f'{date} {minutes // 60:02d}:{minutes % 60:02d}:{rng.randrange(60):02d}',
+                             employee_id, name, action, None))
+    return pd.DataFrame(rows, columns=['timestamp', 'employee_id', 'name', 'action', 'break_type'])
+
+
+def legacy_monthly_report(df: pd.DataFrame) -> pd.DataFrame:
+    """従来の作成方法（従業員・日付ごとの groupby と iterrows）"""
+    df = df.copy()
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%d %H:%M:%S')
+    df['date'] = df['timestamp'].dt.date
+    df['time'] = df['timestamp'].dt.time
+
+    summary_data = []
+    for (employee_id, date), group in df.groupby(['employee_id', 'date']):
+        employee_name = group.iloc[0]['name']
+        punches = {}
+        for _, row in group.iterrows():
+            action = row['action']
+            time_str = row['time'].strftime('%H:%M')
+            if action == 'in':
+                punches['出勤'] = time_str
+            elif action == 'out':
+                punches['退勤'] = time_str
+            elif action == 'out_personal':
+                punches['退出'] = time_str
+            elif action == 'in_personal':
+                punches['戻り'] = time_str
+        summary_data.append({
+            '日付': date.strftime('%Y/%m/%d'),
+            '曜日': ['月', '火', '水', '木', '金', '土', '日'][date.weekday()],
+            '従業員ID': employee_id,
+            '氏名': employee_name,
+            '出勤': punches.get('出勤', ''),
+            '退勤': punches.get('退勤', ''),
+            '退出': punches.get('退出', ''),
+            '戻り': punches.get('戻り', '')
+        })
+    return pd.DataFrame(summary_data)
+
+
+def measure(func: Callable[[pd.DataFrame], pd.DataFrame], df: pd.DataFrame, repeat: int) -> float:
+    """repeat 回実行した中で最速の秒数"""
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(df)
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='勤怠管理システム 月次レポート作成ベンチマーク')
+    parser.add_argument('--employees', type=int, default=1000, help='従業員数')
+    parser.add_argument('--year', type=int, default=2025)
+    parser.add_argument('--month', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数（最速値を表示）')
+    args = parser.parse_args()
+
+    df = generate_month(args.year, args.month, args.employees)
+    print(f"打刻記録: {len(df)}件（従業員{args.employees}人、{args.year}年{args.month}月）")
+
+    expected = legacy_monthly_report(df)
+    actual = build_monthly_report(df)
+    try:
+        pd.testing.assert_frame_equal(actual, expected)
+    except AssertionError as e:
+        print(f"結果が一致しません: {e}")
+        sys.exit(1)
+    print(f"結果一致: {len(actual)}行")
+
+    legacy_seconds = measure(legacy_monthly_report, df, args.repeat)
+    vectorized_seconds = measure(build_monthly_report, df, args.repeat)
+    print(f"  - 従来（groupby + iterrows）: {legacy_seconds:.3f}秒")
+    print(f"  - build_monthly_report:      {vectorized_seconds:.3f}秒")
+    print(f"  - 高速化: {legacy_seconds / vectorized_seconds:.1f}倍")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+顔認証モデル（face-api.js の weights）のビルドツール
+
+static/models に置いたモデル（*-weights_manifest.json と shard ファイル）を、
+モデルごとの内容ハッシュを名前にしたディレクトリ（static/models/build/<hash>/）へ出力し、
+gzip（brotli パッケージがあれば brotli も）で事前圧縮する。
+出力したモデルは /models/<hash>/ から immutable で配信され、端末は一度だけダウンロードする。
+モデルを入れ替えた場合はデプロイ前に再実行する。
+
+使い方:
+    python build_face_models.py
+"""
+
+import os
+import sys
+
+from app import FACE_MODEL_BUILD_FOLDER, FACE_MODEL_SOURCE_FOLDER, build_face_models
+
+
+def main() -> None:
+    if not os.path.isdir(FACE_MODEL_SOURCE_FOLDER):
+        print(f"モデルフォルダが見つかりません: {FACE_MODEL_SOURCE_FOLDER}")
+        sys.exit(1)
+
+    print(f"モデルフォルダ: {FACE_MODEL_SOURCE_FOLDER}")
+    print(f"出力先: {FACE_MODEL_BUILD_FOLDER}")
+
+    try:
+        fingerprints = build_face_models()
+    except Exception as e:
+        print(f"ビルドエラー: {e}")
+        sys.exit(1)
+
+    if not fingerprints:
+        print("モデルファイル（*-weights_manifest.json）がありません")
+        return
+
+    for model, fingerprint in fingerprints.items():
+        print(f"  - {model}: {fingerprint}")
+    print("ビルド完了")
+
+
+if __name__ == "__main__":
+    main()
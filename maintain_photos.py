@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+打刻写真のメンテナンスツール
+
+- 保存期間（PHOTO_RETENTION_DAYS）を過ぎた打刻記録の写真を削除
+- 撮影から PHOTO_RECOMPRESS_AFTER_DAYS 日を過ぎた写真を低画質で再圧縮
+- ファイルが存在しない photo_path の参照を外し、どの打刻記録からも参照されない写真を削除
+
+日付別ディレクトリ単位で処理し、進捗はDBに保存する。中断しても再実行で続きから処理する。
+cron などで定期実行する想定。
+
+使い方:
+    python maintain_photos.py                    # メンテナンスを実行
+    python maintain_photos.py --dry-run          # 対象件数と削減量の確認のみ
+    python maintain_photos.py --max-days 30      # 今回は30日分のディレクトリで打ち切る
+"""
+
+import argparse
+import os
+import sys
+
+from app import (DB_PATH, PHOTO_RECOMPRESS_AFTER_DAYS, PHOTO_RETENTION_DAYS, app,
+                 apply_schema_migrations, get_db_connection, maintain_photos)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='勤怠管理システム 写真メンテナンスツール')
+    parser.add_argument('--dry-run', action='store_true', help='ファイルとDBを変更せず対象件数のみ表示する')
+    parser.add_argument('--max-days', type=int, help='今回処理する日付別ディレクトリの上限')
+    parser.add_argument('--retention-days', type=int, default=PHOTO_RETENTION_DAYS,
+                        help='写真の保存期間（日）。0 は無期限')
+    parser.add_argument('--recompress-after-days', type=int, default=PHOTO_RECOMPRESS_AFTER_DAYS,
+                        help='再圧縮する写真の経過日数。0 は再圧縮しない')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        print("データベースファイルが見つかりません。")
+        sys.exit(1)
+
+    print(f"データベース: {DB_PATH}")
+    print(f"写真フォルダ: {app.config['PHOTO_FOLDER']}")
+    print(f"保存期間: {args.retention_days or '無期限'}日 / 再圧縮: {args.recompress_after_days or 'なし'}日")
+
+    conn = get_db_connection()
+    try:
+        apply_schema_migrations(conn)
+        result = maintain_photos(conn, dry_run=args.dry_run, retention_days=args.retention_days,
+                                 recompress_after_days=args.recompress_after_days, max_days=args.max_days)
+    except Exception as e:
+        print(f"メンテナンスエラー: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    label = "対象" if args.dry_run else "処理"
+    print(f"  - 保存期間を過ぎた打刻記録: {result['expired_rows']}件")
+    print(f"  - ファイルが存在しない打刻記録: {result['missing_rows']}件")
+    print(f"  - 参照されていない写真: {result['orphan_files']}件")
+    print(f"  - 不要な縮小版: {result['variant_files']}件")
+    print(f"  - 再圧縮: {result['recompressed_files']}件")
+    print(f"  - {label}したディレクトリ: {result['days']}日分")
+    print(f"  - 削減容量: {result['bytes_reclaimed'] / (1024 * 1024):.1f}MB")
+    print("確認完了" if args.dry_run else "メンテナンス完了")
+
+
+if __name__ == "__main__":
+    main()
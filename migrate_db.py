@@ -1,44 +1,79 @@
-import sqlite3
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+データベーススキーマ移行ツール
+
+使い方:
+    python migrate_db.py            # 現在のバージョンと未適用のマイグレーションを表示
+    python migrate_db.py --apply    # 未適用のマイグレーションを適用
+"""
+
+import argparse
 import os
+import sys
 
-def migrate_database():
-    """既存のデータベースにbreak_type列を追加"""
-    db_path = 'timecard.db'
-    
-    if not os.path.exists(db_path):
-        print("データベースファイルが見つかりません。")
-        return False
-    
+from app import DB_PATH, SCHEMA_MIGRATIONS, apply_schema_migrations, get_db_connection, get_pending_migrations, get_schema_version
+
+
+def show_status() -> int:
+    """現在のスキーマバージョンと未適用のマイグレーションを表示"""
+    conn = get_db_connection()
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 既存の列を確認
-        cursor.execute("PRAGMA table_info(timecard)")
-        columns = [column[1] for column in cursor.fetchall()]
-        print(f"現在の列: {columns}")
-        
-        # break_type列が存在しない場合は追加
-        if 'break_type' not in columns:
-            print("break_type列を追加中...")
-            cursor.execute("ALTER TABLE timecard ADD COLUMN break_type TEXT")
-            print("break_type列を追加しました")
-        else:
-            print("break_type列は既に存在します")
-        
-        # 変更を確認
-        cursor.execute("PRAGMA table_info(timecard)")
-        updated_columns = [column[1] for column in cursor.fetchall()]
-        print(f"更新後の列: {updated_columns}")
-        
-        conn.commit()
+        current_version = get_schema_version(conn)
+        pending = get_pending_migrations(conn)
+    finally:
         conn.close()
-        print("データベースマイグレーション完了")
-        return True
-        
+
+    latest_version = SCHEMA_MIGRATIONS[-1][0] if SCHEMA_MIGRATIONS else 0
+    print(f"データベース: {DB_PATH}")
+    print(f"現在のスキーマバージョン: v{current_version}（最新: v{latest_version}）")
+
+    if not pending:
+        print("未適用のマイグレーションはありません")
+        return 0
+
+    print(f"未適用のマイグレーション: {len(pending)}件")
+    for version, description, _ in pending:
+        print(f"  - v{version}: {description}")
+    return len(pending)
+
+
+def migrate_database() -> bool:
+    """未適用のマイグレーションを適用"""
+    conn = get_db_connection()
+    try:
+        applied = apply_schema_migrations(conn)
     except Exception as e:
         print(f"マイグレーションエラー: {e}")
         return False
+    finally:
+        conn.close()
+
+    if applied:
+        print(f"適用したマイグレーション: {', '.join(f'v{v}' for v in applied)}")
+    else:
+        print("未適用のマイグレーションはありません")
+    print("データベースマイグレーション完了")
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='勤怠管理システム データベース移行ツール')
+    parser.add_argument('--apply', action='store_true', help='未適用のマイグレーションを適用する')
+    parser.add_argument('--check', action='store_true', help='未適用のマイグレーションがあれば終了コード1を返す')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        print("データベースファイルが見つかりません。")
+        sys.exit(1)
+
+    if args.apply:
+        sys.exit(0 if migrate_database() else 1)
+
+    pending_count = show_status()
+    if args.check and pending_count:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
-    migrate_database()
\ No newline at end of file
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+打刻写真の保存形式移行ツール
+
+PHOTO_FOLDER 直下に保存された旧形式の写真（{employee_id}_{YYYYmmdd_HHMMSS}.jpg）を
+日付別ディレクトリ + 内容ハッシュのファイル名（YYYY/MM/DD/<hash>.jpg）へ移動し、
+ホットDBと月別アーカイブDBの photo_path を書き換える。中断しても再実行で続きから処理する。
+
+使い方:
+    python migrate_photos.py             # 移行を実行
+    python migrate_photos.py --dry-run   # 対象件数の確認のみ
+"""
+
+import argparse
+import os
+import sys
+
+from app import DB_PATH, app, get_db_connection, migrate_flat_photos
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='勤怠管理システム 写真保存形式移行ツール')
+    parser.add_argument('--dry-run', action='store_true', help='ファイルとDBを変更せず対象件数のみ表示する')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_PATH):
+        print("データベースファイルが見つかりません。")
+        sys.exit(1)
+
+    print(f"データベース: {DB_PATH}")
+    print(f"写真フォルダ: {app.config['PHOTO_FOLDER']}")
+
+    conn = get_db_connection()
+    try:
+        result = migrate_flat_photos(conn, dry_run=args.dry_run)
+    except Exception as e:
+        print(f"移行エラー: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    if not result['files']:
+        print("移行対象の写真はありません")
+        return
+
+    if args.dry_run:
+        print(f"移行対象の写真: {result['files']}件")
+        return
+
+    print(f"  - 移動した写真: {result['files']}件")
+    print(f"  - 更新した打刻記録: {result['rows']}件")
+    print("移行完了")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+QRコード名札（バッジ）の描画
+
+従業員ごとの名札画像（QRコード + 氏名 + 従業員ID）と、A4に並べた印刷用ページを描画する。
+プロセスプールのワーカーから呼び出すため、Flaskアプリ（app.py）には依存しない。
+"""
+
+import io
+import os
+import zlib
+from functools import lru_cache
+from typing import IO, Any, Callable, Iterator, List, Optional, Sequence, Tuple
+
+import qrcode  # type: ignore
+from PIL import Image, ImageDraw, ImageFont
+
+# (従業員ID, 氏名, 所属工場)
+BadgeEmployee = Tuple[str, str, str]
+
+# 印刷用ページ: A4 縦、200dpi、3列 x 4段
+PAGE_DPI = 200
+PAGE_SIZE = (1654, 2339)
+PAGE_COLUMNS = 3
+PAGE_ROWS = 4
+PAGE_MARGIN = 60
+BADGES_PER_PAGE = PAGE_COLUMNS * PAGE_ROWS
+
+# 名札1枚のサイズ（ページの1マス）
+BADGE_SIZE = ((PAGE_SIZE[0] - PAGE_MARGIN * 2) // PAGE_COLUMNS,
+              (PAGE_SIZE[1] - PAGE_MARGIN * 2) // PAGE_ROWS)
+
+# 日本語の氏名を描画できるフォントの候補（BADGE_FONT_PATH が優先）
+FONT_CANDIDATES = [
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/fonts-japanese-gothic.ttf',
+    '/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf',
+    '/usr/share/fonts/truetype/takao-gothic/TakaoPGothic.ttf',
+    'C:\\Windows\\Fonts\\meiryo.ttc',
+    'C:\\Windows\\Fonts\\msgothic.ttc',
+]
+
+
+def find_badge_font() -> Optional[str]:
+    """名札に使うフォントファイルを探す（見つからなければ None）"""
+    configured = os.environ.get('BADGE_FONT_PATH')
+    for path in ([configured] if configured else []) + FONT_CANDIDATES:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+@lru_cache(maxsize=16)
+def _load_font(font_path: Optional[str], size: int) -> ImageFont.ImageFont:
+    if font_path:
+        return ImageFont.truetype(font_path, size)
+    return ImageFont.load_default(size)
+
+
+def _draw_centered(draw: ImageDraw.ImageDraw, text: str, center_x: int, top: int,
+                   font: ImageFont.ImageFont, max_width: int) -> int:
+    """中央揃えで1行描画し、次の行の上端を返す（幅を超える場合は末尾を省略）"""
+    while text and draw.textlength(text, font=font) > max_width:
+        text = text[:-2] + '…' if len(text) > 1 else ''
+    left, upper, right, lower = draw.textbbox((0, 0), text, font=font)
+    draw.text((center_x - (right - left) // 2 - left, top - upper), text, fill=0, font=font)
+    return top + (lower - upper)
+
+
+def render_badge(employee: BadgeEmployee, font_path: Optional[str]) -> Image.Image:
+    """名札1枚（QRコード + 氏名 + 従業員ID + 所属工場）をグレースケールで描画"""
+    employee_id, name, factory = employee
+    width, height = BADGE_SIZE
+    badge = Image.new('L', BADGE_SIZE, 255)
+    draw = ImageDraw.Draw(badge)
+    # 切り取り線
+    draw.rectangle((0, 0, width - 1, height - 1), outline=192, width=2)
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=1, border=4)
+    qr.add_data(employee_id)
+    qr.make(fit=True)
+    qr_image = qr.make_image().get_image().convert('L')
+    qr_edge = min(width, height) * 3 // 5
+    qr_edge -= qr_edge % qr_image.size[0]  # モジュールの境界をそろえる
+    badge.paste(qr_image.resize((qr_edge, qr_edge), Image.NEAREST), ((width - qr_edge) // 2, 30))
+
+    text_width = width - 40
+    top = 30 + qr_edge + 20
+    top = _draw_centered(draw, name, width // 2, top, _load_font(font_path, 56), text_width) + 24
+    top = _draw_centered(draw, employee_id, width // 2, top, _load_font(font_path, 40), text_width) + 16
+    if factory:
+        _draw_centered(draw, factory, width // 2, top, _load_font(font_path, 32), text_width)
+    return badge
+
+
+def render_badge_png(employee: BadgeEmployee, font_path: Optional[str]) -> bytes:
+    """名札1枚のPNG"""
+    buffer = io.BytesIO()
+    render_badge(employee, font_path).save(buffer, 'PNG', dpi=(PAGE_DPI, PAGE_DPI))
+    return buffer.getvalue()
+
+
+def render_badge_page(employees: Sequence[BadgeEmployee], font_path: Optional[str]) -> bytes:
+    """名札を最大 BADGES_PER_PAGE 枚並べたページを描画し、Flate圧縮したグレースケール画素を返す"""
+    page = Image.new('L', PAGE_SIZE, 255)
+    for index, employee in enumerate(employees[:BADGES_PER_PAGE]):
+        row, column = divmod(index, PAGE_COLUMNS)
+        page.paste(render_badge(employee, font_path),
+                   (PAGE_MARGIN + column * BADGE_SIZE[0], PAGE_MARGIN + row * BADGE_SIZE[1]))
+    return zlib.compress(page.tobytes())
+
+
+def render_chunk(func: Callable[..., Any], arguments: Sequence[tuple]) -> List[Any]:
+    """func(*args) を順に実行した結果の一覧（プロセスプールへの受け渡しをまとめて減らす）"""
+    return [func(*args) for args in arguments]
+
+
+def chunk_pages(employees: Sequence[BadgeEmployee]) -> List[Sequence[BadgeEmployee]]:
+    """従業員をページ単位に分割"""
+    return [employees[i:i + BADGES_PER_PAGE] for i in range(0, len(employees), BADGES_PER_PAGE)]
+
+
+class PdfPageWriter:
+    """
+    render_badge_page() のページを順に書き出す最小限のPDFライター
+
+    ページごとに書き出して破棄するため、ページ数が増えてもメモリ使用量は増えない。
+    """
+
+    def __init__(self, output: IO[bytes]) -> None:
+        self._output = output
+        self._offset = 0
+        self._offsets: List[int] = []
+        self._page_refs: List[int] = []
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data: bytes) -> None:
+        self._output.write(data)
+        self._offset += len(data)
+
+    def _object(self, body: bytes, stream: Optional[bytes] = None) -> int:
+        number = len(self._offsets) + 3  # 1: Catalog, 2: Pages は最後に書く
+        self._offsets.append(self._offset)
+        self._write(f'{number} 0 obj\n'.encode() + body)
+        if stream is not None:
+            self._write(b'\nstream\n' + stream + b'\nendstream')
+        self._write(b'\nendobj\n')
+        return number
+
+    def add_page(self, compressed_pixels: bytes) -> None:
+        width, height = PAGE_SIZE
+        image = self._object(
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray '
+            f'/BitsPerComponent 8 /Filter /FlateDecode /Length {len(compressed_pixels)} >>'.encode(),
+            compressed_pixels
+        )
+        # A4（ポイント単位）いっぱいに画像を配置
+        page_width, page_height = width * 72 / PAGE_DPI, height * 72 / PAGE_DPI
+        content = f'q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q'.encode()
+        contents = self._object(f'<< /Length {len(content)} >>'.encode(), content)
+        self._page_refs.append(self._object(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] '
+            f'/Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {contents} 0 R >>'.encode()
+        ))
+
+    def close(self) -> None:
+        offsets = {1: self._offset}
+        self._write(b'1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+        offsets[2] = self._offset
+        kids = ' '.join(f'{ref} 0 R' for ref in self._page_refs)
+        self._write(f'2 0 obj\n<< /Type /Pages /Kids [{kids}] /Count {len(self._page_refs)} >>\nendobj\n'.encode())
+        offsets.update({number: offset for number, offset in enumerate(self._offsets, start=3)})
+
+        xref_offset = self._offset
+        lines = [f'xref\n0 {len(offsets) + 1}\n', '0000000000 65535 f \n']
+        lines += [f'{offsets[number]:010d} 00000 n \n' for number in range(1, len(offsets) + 1)]
+        lines.append(f'trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self._write(''.join(lines).encode())
+
+
+class StreamBuffer(io.RawIOBase):
+    """書き込まれたデータを取り出せるバッファ（ZIP/PDFの逐次送信用、シーク不可）"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:  # type: ignore[override]
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> Iterator[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return iter(chunks)
+